@@ -3,19 +3,26 @@
 """DConnect application class"""
 
 import sys
+import glob
 import signal
 import socket
 import logging.handlers
 from random import randint
-from threading import Thread
-from socketserver import ThreadingUDPServer, UDPServer
+import time
+from threading import Thread, Lock
+from typing import Tuple, Iterator
+from socketserver import UDPServer
 
-from .device_manager import DeviceManager, Device
-from .server_search import ServerSearchHandler
+from .device_manager import DeviceManager, Device, SqliteRegistry
+from .hooks import HookExecutor
+from .workers import WorkerPool
+from .server_search import ServerSearchHandler, DiscoveryResponder
 from .tcp_server import DConnectThreadingTCPServer, DConnectHandler
-from .plugins import PLUGINS, PluginInitializer
+from .plugins import PluginInitializer, PluginRegistry
 from .common.jsonconf import *
+from .common import crypto
 from .common.daemon import Daemon
+from .timing import StartupProfile
 
 
 class DConnectApp(Daemon):
@@ -34,27 +41,51 @@ class DConnectApp(Daemon):
                         default=''.join(tuple(chr(randint(ord('a'), ord('z'))) for _ in range(10)))),
         )),
         IntEntry('port', 'Port for UDP and TCP sockets', False, 1, 0xFFFF, 5040),
+        DictEntry('hooks', 'Execution of commands invoked on events (on_done, on_download, etc)', False, entries=(
+            IntEntry('workers', 'Max count of commands running at once', False, 1, 1024, 4),
+            IntEntry('timeout', 'Command execution timeout in seconds, 0 - unlimited', False, 0, 86400, 0),
+            IntEntry('concurrency', 'Max count of running instances of one command', False, 1, 1024, 1),
+            IntEntry('debounce', 'Delay in milliseconds to coalesce burst of same command into one run, '
+                                 '0 - no coalescing', False, 0, 3600000, 0),
+        )),
+        ChoiceEntry('fsync', 'Flushing of received files to disk: none - up to OS, file - every file on receive, '
+                             'session - all files on connection end', True, ('none', 'file', 'session'), 'none'),
+        IntEntry('reload_interval', 'Interval in seconds to check configuration files for changes and reload them, '
+                                    '0 - reload on SIGHUP only', True, 0, 86400, 0),
+        IntEntry('workers', 'Count of processes handling TCP connections, 1 - handle them in main process',
+                 True, 1, 256, 1),
+        ChoiceEntry('crypto', 'Encryption backend: auto - the fastest installed one, pycryptodome or '
+                              'cryptography (OpenSSL)', True, ('auto', 'pycryptodome', 'cryptography'), 'auto'),
+        ChoiceEntry('registry', 'Storage of known devices: files - JSON file per device in "devices" directory, '
+                                'sqlite - single database file "devices.sqlite"', True, ('files', 'sqlite'), 'files'),
         FileEntry('pidfile', 'Path to pidfile for daemon mode', True, '', False, False)
     ))
+    RESTART_REQUIRED_KEYS = 'log', 'port', 'hooks', 'pidfile', 'reload_interval', 'registry', 'workers', 'crypto'
 
-    def __init__(self, directory: str, foreground: bool):
+    def __init__(self, directory: str, foreground: bool, profile: Optional[StartupProfile] = None):
         super().__init__()
+        self.profile = StartupProfile() if profile is None else profile
         self.dev = None
         self.xdg_runtime_dir = '/tmp'
         self.directory = directory
         self.foreground = foreground
         self.environment = self.init_environment()
-        self.conf = self.init_conf(os.path.join(directory, 'conf.json'))
+        with self.profile.stage('load configuration'):
+            self.conf = self.init_conf(os.path.join(directory, 'conf.json'))
         conf_pidfile = self.conf.get('pidfile')
         self.pidfile = conf_pidfile if conf_pidfile else os.path.join(self.xdg_runtime_dir, 'dcnnt.pid')
         self.log = self.init_logger()
-        self.dm = self.plugins = self.udp = self.tcp = self.udp_thread = self.tcp_thread = None
+        self.dm = self.plugins = self.hooks = self.udp = self.tcp = self.workers = None
+        self.udp_thread = self.tcp_thread = self.plugins_thread = None
+        self.reload_lock = Lock()
+        self.conf_signature = None
 
     def pair(self, code: Optional[str] = None):
         """Start app in pairing mode, using pre-defined or random (default) pairing code"""
         if code is None:
             code = str(randint(100000, 999999))
         self.log.setLevel(logging.WARNING)
+        self.init_crypto()
         self.dm = self.init_dm()
         print('App running in pairing mode')
         print(f'Pair code:\n\n    {code[:3]}-{code[3:]}    \n')
@@ -68,15 +99,53 @@ class DConnectApp(Daemon):
         print(f'Successful pairing with device {paired_uin}' if paired_uin else 'Pairing failed')
         udp.server_close()
         del udp
+        self.dm.flush()
         sys.exit(0 if paired_uin else 1)
 
     def init(self):
         """Create various app internal entities"""
-        self.dm = self.init_dm()
+        with self.profile.stage('init crypto'):
+            self.init_crypto()
+        with self.profile.stage('init devices'):
+            self.dm = self.init_dm()
+        if self.conf.get('workers', 1) > 1:
+            self.workers = WorkerPool(self, self.conf['workers'])
+        else:
+            self.init_connections()
+        with self.profile.stage('init UDP server'):
+            self.udp = self.init_udp()
+        self.udp_thread = self.tcp_thread = self.plugins_thread = None
+
+    def init_crypto(self):
+        """Select encryption backend, check that frames of installed backends are compatible"""
+        name = self.conf.get('crypto', 'auto')
+        try:
+            backend = crypto.set_backend(name)
+        except ValueError as e:
+            self.log.error(f'{e}, select available one')
+            backend = crypto.set_backend('auto')
+        error = crypto.self_check()
+        if error is not None:
+            self.log.error(f'Crypto backends self-check failed: {error}')
+            if backend.NAME != crypto.PycryptodomeBackend.NAME and crypto.PycryptodomeBackend.available():
+                backend = crypto.set_backend(crypto.PycryptodomeBackend.NAME)
+        self.log.info(f'Crypto backend: {backend.NAME}')
+
+    def report_crypto(self):
+        """Log measured speed of installed encryption backends"""
+        for backend in crypto.available_backends():
+            encryption, decryption = crypto.measure_throughput(backend)
+            selected = ' (selected)' if backend is crypto.backend else ''
+            self.log.info(f'Crypto backend {backend.NAME}{selected}: encryption {encryption:.0f} MiB/s, '
+                          f'decryption {decryption:.0f} MiB/s')
+
+    def init_connections(self, reuse_port: bool = False):
+        """Create entities to handle TCP connections: hooks, plugins and TCP server"""
+        with self.profile.stage('init hooks'):
+            self.hooks = self.init_hooks()
         self.plugins = self.init_plugins()
-        self.udp = self.init_udp()
-        self.tcp = self.init_tcp()
-        self.udp_thread = self.tcp_thread = None
+        with self.profile.stage('init TCP server'):
+            self.tcp = self.init_tcp(reuse_port)
 
     def init_environment(self):
         """Load environment variables, add some local variables and set current directory to config dir"""
@@ -106,42 +175,168 @@ class DConnectApp(Daemon):
             logger.addHandler(logging.StreamHandler(sys.stdout))
         return logger
 
-    def init_conf(self, path):
-        """Load configuration from JSON file"""
+    def load_conf(self, path) -> Tuple[Dict[str, Any], Device]:
+        """Load configuration from JSON file, create device object of server"""
         res = ConfigLoader(self.environment, path, self.CONFIG_SCHEMA, True).load()
         if isinstance(res, dict):
             info = res['self']
-            dev = Device(info['uin'], info['name'], info['description'], 'server', info['password'])
-            self.dev = dev
-            return res
+            return res, Device(info['uin'], info['name'], info['description'], 'server', info['password'])
         else:
             raise ValueError(f'Main configuration error: {res}')
 
+    def init_conf(self, path):
+        """Load configuration from JSON file"""
+        res, self.dev = self.load_conf(path)
+        return res
+
+    def create_dm(self, registry: str) -> DeviceManager:
+        """Create empty device manager using selected storage of devices"""
+        directory = os.path.join(self.directory, 'devices')
+        if registry == 'sqlite':
+            return DeviceManager(self, directory, SqliteRegistry(os.path.join(self.directory,
+                                                                              DeviceManager.REGISTRY_FILENAME)))
+        return DeviceManager(self, directory)
+
     def init_dm(self):
         """Init device manager"""
-        dm = DeviceManager(self, os.path.join(self.directory, 'devices'))
+        dm = self.create_dm(self.conf.get('registry'))
         dm.load()
         return dm
 
-    def init_plugins(self):
-        """Init selected plugins and load settings"""
-        plugins = dict()
+    def import_devices(self) -> int:
+        """Copy devices from JSON files to registry database, return count of devices"""
+        dm = self.create_dm('files')
+        dm.load()
+        self.create_dm('sqlite').registry.save(dm.values())
+        return len(dm)
+
+    def export_devices(self) -> int:
+        """Copy devices from registry database to JSON files, return count of devices"""
+        dm = self.create_dm('sqlite')
+        dm.load()
+        os.makedirs(dm.directory, exist_ok=True)
+        for device in dm.values():
+            dm.dump_device_file(device)
+        return len(dm)
+
+    def init_hooks(self):
+        """Init executor of hook commands"""
+        conf = self.conf['hooks']
+        return HookExecutor(self.log, self.environment, conf['workers'], conf['timeout'], conf['concurrency'],
+                            conf['debounce'])
+
+    def init_plugins(self, plugins: Optional[Dict[bytes, Any]] = None) -> PluginRegistry:
+        """Create registry of plugins, plugins are imported and configured on first use"""
+        return PluginRegistry(self.environment, os.path.join(self.directory, 'plugins'), self.log, self.profile,
+                              plugins)
+
+    def load_plugins(self):
+        """Init all plugins in background after start of servers"""
+        plugins = self.plugins
+        plugins.load_all()
+        if plugins.stopped:
+            return
+        self.profile.mark('all plugins loaded')
+        self.log.info(f'Plugins loaded: {", ".join(i.NAME for i in plugins.plugins.values() if i)}')
+
+    def conf_files_signature(self) -> Tuple[Tuple[str, int, int], ...]:
+        """Get paths, modification times and sizes of all configuration files"""
+        paths = [os.path.join(self.directory, 'conf.json')]
+        paths += glob.glob(os.path.join(self.directory, 'devices', DeviceManager.FILENAME_TEMPLATE.format('*')))
+        paths += glob.glob(os.path.join(self.directory, 'plugins', '*.conf.json'))
+        res = list()
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            res.append((path, stat.st_mtime_ns, stat.st_size))
+        return tuple(res)
+
+    def reload(self) -> bool:
+        """Reload main, devices and plugins configurations. New configuration is loaded and validated completely
+        before use, connections started earlier finish with previous one"""
+        with self.reload_lock:
+            self.log.info('Reload configuration')
+            self.conf_signature = self.conf_files_signature()
+            try:
+                conf, dev = self.load_conf(os.path.join(self.directory, 'conf.json'))
+            except ValueError as e:
+                self.log.error(f'Reload canceled: {e}')
+                return False
+            for key in self.RESTART_REQUIRED_KEYS:
+                if conf.get(key) != self.conf.get(key):
+                    self.log.warning(f'Option "{key}" changed, restart required to apply it')
+                    conf[key] = self.conf.get(key)
+            if self.workers is None or self.workers.index is None:  # devices are saved by master process only
+                self.dm.flush()
+            dm = self.create_dm(conf.get('registry'))
+            dm.load(dev)
+            plugins = None if self.plugins is None else self.reload_plugins()
+            for uin, device in dm.items():
+                old_device = self.dm.get(uin)
+                if old_device is not None:
+                    device.ip = old_device.ip
+            self.conf, self.dev, self.dm, self.plugins = conf, dev, dm, plugins
+            if plugins is not None:
+                self.plugins_thread = Thread(None, self.load_plugins, 'Thread-Plugins-Load', daemon=True)
+                self.plugins_thread.start()
+            self.log.info('Configuration reloaded')
+            if self.workers is not None and self.workers.index is None:
+                self.workers.send_signal(signal.SIGHUP)
+            return True
+
+    def fork_locks(self) -> Iterator[Lock]:
+        """Locks which other threads of master may hold while worker is forked, in order of acquiring"""
+        yield self.reload_lock
+        if self.dm is not None:
+            yield self.dm.unsaved_lock
+            if self.dm.registry is not None:
+                yield self.dm.registry.lock
+
+    def reload_plugins(self) -> PluginRegistry:
+        """Load and apply configurations of initialized plugins, plugin with invalid configuration keeps previous one.
+        Plugins not initialized yet are initialized by new registry with new configuration on first use"""
+        self.plugins.stop()
+        if self.plugins_thread is not None:
+            self.plugins_thread.join()
         plugins_dir = os.path.join(self.directory, 'plugins')
-        for plg in PLUGINS:
+        plugins, plugin_confs = dict(), list()
+        for mark, plg in self.plugins.plugins.items():
+            if plg is None:
+                continue
             initer = PluginInitializer(self.environment, plugins_dir, self.log, plg)
-            if initer.init_plugin():
-                plugins[plg.MARK] = plg
-        return plugins
+            confs = initer.load()
+            if confs is not None:
+                plugin_confs.append((initer, confs))
+            else:
+                self.log.warning(f'Plugin "{plg.NAME}" keeps previous configuration')
+            plugins[mark] = plg
+        for initer, confs in plugin_confs:
+            initer.apply(*confs)
+        return self.init_plugins(plugins)
+
+    def watch_conf(self, interval: int):
+        """Reload configuration on files change"""
+        while True:
+            time.sleep(interval)
+            if self.conf_files_signature() != self.conf_signature:
+                try:
+                    self.reload()
+                except Exception as e:
+                    self.log.exception(e)
+
+    def on_sighup(self, *args):
+        """SIGHUP handler"""
+        Thread(target=self.reload, name='Thread-Reload', daemon=True).start()
 
     def init_udp(self):
         """Init and start UDP server"""
-        server = ThreadingUDPServer(('0.0.0.0', self.conf['port']), ServerSearchHandler)
-        server.app = self
-        return server
+        return DiscoveryResponder(self, ('0.0.0.0', self.conf['port']))
 
-    def init_tcp(self):
+    def init_tcp(self, reuse_port: bool = False):
         """Init and start TCP server"""
-        server = DConnectThreadingTCPServer(self, ('0.0.0.0', self.conf['port']), DConnectHandler)
+        server = DConnectThreadingTCPServer(self, ('0.0.0.0', self.conf['port']), DConnectHandler, reuse_port)
         return server
 
     def on_sigint(self, *args):
@@ -153,28 +348,71 @@ class DConnectApp(Daemon):
         """Start application"""
         if not self.foreground:
             signal.signal(signal.SIGINT, self.on_sigint)
+        signal.signal(signal.SIGHUP, self.on_sighup)
         self.log.info('START APP')
+        if self.workers is not None:
+            self.log.debug(f'Starting {self.workers.count} workers...')
+            self.workers.start()  # fork before start of any thread
+        self.conf_signature = self.conf_files_signature()
+        if self.conf.get('reload_interval'):
+            Thread(target=self.watch_conf, args=(self.conf['reload_interval'], ), name='Thread-Reload-Watch',
+                   daemon=True).start()
         self.udp_thread = Thread(None, self.udp.serve_forever, 'UDP-Server-Thread')
         self.log.debug('Starting UDP server...')
         self.udp_thread.start()
+        if self.workers is None:
+            self.start_connections()
+        else:
+            self.profile.mark('servers started')
+        Thread(target=self.report_crypto, name='Thread-Crypto-Report', daemon=True).start()
+        if not self.foreground:
+            (self.udp_thread if self.tcp_thread is None else self.tcp_thread).join()
+
+    def start_connections(self):
+        """Start hook workers, TCP server and loading of plugins"""
+        self.hooks.start()  # threads are started after fork of daemon or worker
         self.log.debug('Starting TCP server...')
         self.tcp_thread = Thread(None, self.tcp.serve_forever, 'TCP-Server-Thread')
         self.tcp_thread.start()
-        if not self.foreground:
-            self.tcp_thread.join()
+        self.profile.mark('servers started')
+        self.plugins_thread = Thread(None, self.load_plugins, 'Thread-Plugins-Load', daemon=True)
+        self.plugins_thread.start()
+
+    def run_worker(self, index: int):
+        """Handle TCP connections in worker process until stop"""
+        self.log.info(f'START WORKER {index} (PID {os.getpid()})')
+        self.udp.server_close()  # socket of master process
+        self.udp = self.udp_thread = None
+        self.init_connections(True)
+        self.start_connections()
+        Thread(target=self.workers.receive_forever, args=(self.tcp, ), name='Thread-Worker-Receive',
+               daemon=True).start()
+        self.tcp_thread.join()
+        self.tcp.server_close()
+        self.log.info(f'STOP WORKER {index}')
+
+    def stop_worker(self):
+        """SIGTERM handler of worker process"""
+        Thread(target=self.tcp.shutdown, name='Thread-TCP-Shutdown', daemon=True).start()
 
     def shutdown(self):
         """Stop all threads and whole application"""
         self.log.info('STOP APP')
         self.log.debug('Shutdown UDP and TCP servers')
         self.udp.shutdown()
-        self.tcp.shutdown()
+        if self.workers is not None:
+            self.log.debug('Waiting workers stop...')
+            self.workers.stop()
+        else:
+            self.tcp.shutdown()
         self.log.debug('Waiting UDP server stop...')
         self.udp_thread.join()
-        self.log.debug('Waiting TCP server stop...')
-        self.tcp_thread.join()
-        self.log.debug('Close TCP socket...')
-        self.tcp.server_close()
+        if self.tcp is not None:
+            self.log.debug('Waiting TCP server stop...')
+            self.tcp_thread.join()
+            self.log.debug('Close TCP socket...')
+            self.tcp.server_close()
         self.log.debug('Close UDP socket...')
         self.udp.server_close()
+        self.dm.flush()
         sys.exit(0)
@@ -0,0 +1,40 @@
+"""Streaming compression of stored files, zstd support is optional and requires "zstandard" package"""
+
+import gzip
+import shutil
+from typing import Optional, BinaryIO
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_METHODS = 'none', 'gzip', 'zstd'
+COMPRESSION_SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+
+
+def compression_method(name: Optional[str]) -> Optional[str]:
+    """Get available compression method for configured one, zstd falls back to gzip if not installed"""
+    if name == 'zstd' and zstandard is None:
+        return 'gzip'
+    return None if name in {None, 'none'} else name
+
+
+def compression_suffix(method: Optional[str]) -> str:
+    """Get file name suffix for compression method"""
+    return COMPRESSION_SUFFIXES.get(method, '')
+
+
+def open_compressed(path: str, mode: str, method: Optional[str]) -> BinaryIO:
+    """Open file for binary read or write with transparent compression"""
+    if method == 'gzip':
+        return gzip.GzipFile(path, mode, mtime=0)  # zero mtime to get same output for same content
+    if method == 'zstd':
+        return zstandard.open(path, mode)
+    return open(path, mode)
+
+
+def decompress_file(path: str, method: Optional[str], out_path: str, part: int = 65536):
+    """Write decompressed content of file to another file"""
+    with open_compressed(path, 'rb', method) as src, open(out_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, part)
@@ -0,0 +1,153 @@
+"""AES-GCM encryption of frames with interchangeable backends: pycryptodome and cryptography (OpenSSL).
+Frame is 16 bytes nonce, encrypted data and 16 bytes digest, it is the same for all backends"""
+
+import os
+import time
+from functools import lru_cache
+from typing import Optional, Dict, List, Tuple
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    AESGCM = InvalidTag = None
+
+NONCE_SIZE = 16
+DIGEST_SIZE = 16
+
+
+class CryptoBackend:
+    """Implementation of frames encryption"""
+    NAME = ''
+
+    @staticmethod
+    def available() -> bool:
+        """Check if required package is installed"""
+        raise NotImplementedError
+
+    def encrypt(self, data: bytes, key: bytes) -> bytes:
+        """Encrypt data using AES in GCM mode, nonce and digest included"""
+        raise NotImplementedError
+
+    def decrypt(self, data: bytes, key: bytes) -> Optional[bytes]:
+        """Decrypt data using AES in GCM mode, also check integrity, None if check failed"""
+        raise NotImplementedError
+
+
+class PycryptodomeBackend(CryptoBackend):
+    """Encryption by pycryptodome package"""
+    NAME = 'pycryptodome'
+
+    @staticmethod
+    def available() -> bool:
+        return AES is not None
+
+    def encrypt(self, data: bytes, key: bytes) -> bytes:
+        cipher = AES.new(key, AES.MODE_GCM)
+        encrypted, digest = cipher.encrypt_and_digest(data)
+        return b''.join((cipher.nonce, encrypted, digest))
+
+    def decrypt(self, data: bytes, key: bytes) -> Optional[bytes]:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=data[:NONCE_SIZE])
+        try:
+            return cipher.decrypt_and_verify(data[NONCE_SIZE:-DIGEST_SIZE], data[-DIGEST_SIZE:])
+        except (ValueError, KeyError):
+            return
+
+
+class CryptographyBackend(CryptoBackend):
+    """Encryption by OpenSSL using cryptography package, GIL is released while big buffers are processed"""
+    NAME = 'cryptography'
+
+    @staticmethod
+    def available() -> bool:
+        return AESGCM is not None
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def cipher(key: bytes) -> 'AESGCM':
+        """Get cipher object for key, key schedule is computed once"""
+        return AESGCM(key)
+
+    def encrypt(self, data: bytes, key: bytes) -> bytes:
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.cipher(key).encrypt(nonce, data, None)
+
+    def decrypt(self, data: bytes, key: bytes) -> Optional[bytes]:
+        if len(data) < NONCE_SIZE + DIGEST_SIZE:
+            return
+        data = memoryview(data)
+        try:
+            return self.cipher(key).decrypt(bytes(data[:NONCE_SIZE]), data[NONCE_SIZE:], None)
+        except (InvalidTag, ValueError):
+            return
+
+
+BACKENDS: Dict[str, CryptoBackend] = {i.NAME: i() for i in (CryptographyBackend, PycryptodomeBackend)}
+backend: Optional[CryptoBackend] = next((i for i in BACKENDS.values() if i.available()), None)
+
+
+def available_backends() -> List[CryptoBackend]:
+    """Get backends with installed packages, faster first"""
+    return [i for i in BACKENDS.values() if i.available()]
+
+
+def set_backend(name: str) -> CryptoBackend:
+    """Select backend by name or the fastest one if name is "auto", raise ValueError if not available"""
+    global backend
+    candidates = available_backends() if name == 'auto' else [BACKENDS[name]]
+    if not candidates or not candidates[0].available():
+        raise ValueError(f'Crypto backend "{name}" is not available, install required package')
+    backend = candidates[0]
+    return backend
+
+
+def encrypt(data: bytes, key: bytes) -> bytes:
+    """Encrypt data using AES in GCM mode, nonce and digest included"""
+    return backend.encrypt(data, key)
+
+
+def decrypt(data: bytes, key: bytes) -> Optional[bytes]:
+    """Decrypt data using AES in GCM mode, also check integrity"""
+    return backend.decrypt(data, key)
+
+
+def self_check() -> Optional[str]:
+    """Check that every available backend decrypts frames of others and rejects damaged ones,
+    return error message or None"""
+    key = bytes(range(32))
+    samples = b'', b'x', bytes(range(256)) * 300
+    backends = available_backends()
+    for src in backends:
+        for dst in backends:
+            for data in samples:
+                frame = src.encrypt(data, key)
+                if len(frame) != len(data) + NONCE_SIZE + DIGEST_SIZE:
+                    return f'Frame of {src.NAME} has wrong length'
+                if dst.decrypt(frame, key) != data:
+                    return f'Frame of {src.NAME} is not decrypted by {dst.NAME}'
+                damaged = frame[:-1] + bytes((frame[-1] ^ 1, ))
+                if dst.decrypt(damaged, key) is not None:
+                    return f'Damaged frame of {src.NAME} is accepted by {dst.NAME}'
+    return None
+
+
+def measure_throughput(crypto: CryptoBackend, size: int = 1 << 20, duration: float = 0.1) -> Tuple[float, float]:
+    """Measure encryption and decryption speed of backend in MiB/s"""
+    key, data = bytes(32), bytes(size)
+    res = list()
+    for func, arg in ((crypto.encrypt, data), (crypto.decrypt, crypto.encrypt(data, key))):
+        count, start = 0, time.perf_counter()
+        while True:
+            func(arg, key)
+            count += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+        res.append(count * size / elapsed / (1 << 20))
+    return res[0], res[1]
@@ -1,7 +1,21 @@
 import os
+import re
 import json
+import time
+import hashlib
+from stat import S_ISDIR
 from string import Template
-from typing import Optional, Iterable, Union, Any, Dict
+from typing import Optional, Iterable, Union, Any, Dict, Callable, Tuple, Set
+
+# Compiled validator: takes raw value and environment, returns processed value and error message or None
+Validator = Callable[[Any, Optional[Dict[str, str]]], Tuple[Any, Optional[str]]]
+# Compiled check of filesystem paths in already validated value, returns error message or None
+PathsValidator = Callable[[Any], Optional[str]]
+
+VALIDATORS_VERSION = 2  # change on changes of validation logic or default values to invalidate cached configs
+RACY_INTERVAL = 2000000000  # files modified within this interval (ns) are not cached, mtime may not change
+ENV_VAR_PATTERN = re.compile(r'\$\{?([_a-zA-Z][_a-zA-Z0-9]*)')
+DEFAULT_LINE_PATTERN = re.compile(r'^ *default: .*\n', re.MULTILINE)
 
 
 class ConfEntryBase:
@@ -11,6 +25,7 @@ class ConfEntryBase:
     def __init__(self, name: str, description: str, optional: bool, default):
         self.name, self.description, self.optional = name, description, optional
         self.default = default() if callable(default) else default
+        self._compiled: Optional[CompiledSchema] = None
 
     def pre_process(self, value, environment: Optional[Dict[str, str]] = None) -> Any:
         """Process data from JSON before check"""
@@ -24,6 +39,26 @@ class ConfEntryBase:
         """Get default value for this entry"""
         return self.default
 
+    def compile(self) -> Validator:
+        """Create function doing pre-processing and check of value"""
+        pre_process, check = self.pre_process, self.check
+
+        def validate(value, environment=None):
+            value = pre_process(value, environment)
+            return value, check(value, environment)
+
+        return validate
+
+    def compile_paths(self) -> Optional[PathsValidator]:
+        """Create function to check filesystem paths in validated value, None if there are no paths"""
+        return None
+
+    def compiled(self) -> 'CompiledSchema':
+        """Get validators of schema, they are created once"""
+        if self._compiled is None:
+            self._compiled = CompiledSchema(self)
+        return self._compiled
+
 
 class IntEntry(ConfEntryBase):
     """Description of integer config entry"""
@@ -48,7 +83,54 @@ class IntEntry(ConfEntryBase):
         if value > self.max:
             return f'Value of "{self.name}" ({value}) is more than max value ({self.max})'
         if value < self.min:
-            return f'Value of "{self.name}" ({value}) is less than min value ({self.max})'
+            return f'Value of "{self.name}" ({value}) is less than min value ({self.min})'
+
+    def compile(self) -> Validator:
+        name, optional, default, min_value, max_value = self.name, self.optional, self.default, self.min, self.max
+
+        def validate(value, environment=None):
+            if value is None and optional:
+                value = default
+                if value is None:
+                    return value, None
+            if not isinstance(value, int):
+                return value, f'Type of "{name}" is {type(value)}, integer expected'
+            if value > max_value:
+                return value, f'Value of "{name}" ({value}) is more than max value ({max_value})'
+            if value < min_value:
+                return value, f'Value of "{name}" ({value}) is less than min value ({min_value})'
+            return value, None
+
+        return validate
+
+
+class BoolEntry(ConfEntryBase):
+    """Description of boolean config entry"""
+
+    def __str__(self):
+        return f'{self.name} - boolean{", optional" if self.optional else ""}\n' \
+               f'    default: {self.default}\n' \
+               f'    {self.description}\n'
+
+    def check(self, value, environment: Optional[Dict[str, str]] = None):
+        if self.optional and value is None:
+            return
+        if not isinstance(value, bool):
+            return f'Type of "{self.name}" is {type(value)}, boolean expected'
+
+    def compile(self) -> Validator:
+        name, optional, default = self.name, self.optional, self.default
+
+        def validate(value, environment=None):
+            if value is None and optional:
+                value = default
+                if value is None:
+                    return value, None
+            if not isinstance(value, bool):
+                return value, f'Type of "{name}" is {type(value)}, boolean expected'
+            return value, None
+
+        return validate
 
 
 class StringEntry(ConfEntryBase):
@@ -70,12 +152,66 @@ class StringEntry(ConfEntryBase):
         if self.optional and value is None:
             return
         if not isinstance(value, str):
-            return f'Type of "{self.name}" is {type(value)}, integer expected'
+            return f'Type of "{self.name}" is {type(value)}, string expected'
         length = len(value)
         if length > self.max_length:
             return f'Length of "{self.name}" ({length}) is more than max ({self.max_length})'
         if length < self.min_length:
-            return f'Length of "{self.name}" ({length}) is less than min ({self.max_length})'
+            return f'Length of "{self.name}" ({length}) is less than min ({self.min_length})'
+
+    def compile_string(self, extra_check: Optional[Callable[[str], Optional[str]]] = None,
+                       substitute: bool = False) -> Validator:
+        """Create validator of string, extra check is called for string of correct length,
+        environment variables in value are substituted if required"""
+        name, optional, default = self.name, self.optional, self.default
+        min_length, max_length = self.min_length, self.max_length
+
+        def validate(value, environment=None):
+            if value is None and optional:
+                value = default
+            if substitute:
+                value = Template(value).safe_substitute(environment)
+            elif value is None and optional:
+                return value, None
+            if not isinstance(value, str):
+                return value, f'Type of "{name}" is {type(value)}, string expected'
+            length = len(value)
+            if length > max_length:
+                return value, f'Length of "{name}" ({length}) is more than max ({max_length})'
+            if length < min_length:
+                return value, f'Length of "{name}" ({length}) is less than min ({min_length})'
+            return value, None if extra_check is None else extra_check(value)
+
+        return validate
+
+    def compile(self) -> Validator:
+        return self.compile_string()
+
+
+class ChoiceEntry(StringEntry):
+    """Description of string config entry with fixed set of allowed values"""
+
+    def __init__(self, name: str, description: str, optional: bool, choices: Iterable[str], default: Optional[str]):
+        super().__init__(name, description, optional, 0, max(map(len, choices)), default)
+        self.choices = tuple(choices)
+
+    def __str__(self):
+        return f'{self.name} - string{", optional" if self.optional else ""}\n' \
+               f'    default: {self.default}\n' \
+               f'    allowed values: {", ".join(self.choices)}\n' \
+               f'    {self.description}\n'
+
+    def check(self, value, environment: Optional[Dict[str, str]] = None):
+        res = super().check(value, environment)
+        if res is None and value is not None and value not in self.choices:
+            return f'Value of "{self.name}" ({value}) is not one of {self.choices}'
+        return res
+
+    def compile(self) -> Validator:
+        name, choices = self.name, self.choices
+        allowed = frozenset(choices)
+        return self.compile_string(lambda value: None if value in allowed else
+                                   f'Value of "{name}" ({value}) is not one of {choices}')
 
 
 class Rep:
@@ -122,6 +258,22 @@ class TemplateEntry(StringEntry):
         else:
             return res
 
+    def compile(self) -> Validator:
+        test_dict = {i.name: '%TEST%' for i in self.replacements}
+        keys = tuple(test_dict.keys())
+        required = tuple('{' + i.name for i in self.replacements if not i.optional)
+
+        def check_template(value: str) -> Optional[str]:
+            try:
+                value.format(**test_dict)
+            except KeyError as e:
+                return f'Template key failed {str(e)}, required keys: {keys}'
+            for key in required:
+                if key not in value:
+                    return f'Key "{key[1:]}" not found in template, required keys: {keys}'
+
+        return self.compile_string(check_template)
+
 
 class FileEntry(StringEntry):
     """Description of filesystem path config entry"""
@@ -148,6 +300,10 @@ class FileEntry(StringEntry):
         res = super().check(value, environment)
         if res is not None:
             return res
+        return self.check_path(value)
+
+    def check_path(self, value: str) -> Optional[str]:
+        """Check if file exists or its directory exists, create directory if allowed"""
         if not os.path.isfile(value):
             if self.exists:
                 return f'File "{value}" not found'
@@ -164,6 +320,13 @@ class FileEntry(StringEntry):
                     else:
                         return f'Directory not found "{dir_path}"'
 
+    def compile(self) -> Validator:
+        return self.compile_string(self.check_path, substitute=True)
+
+    def compile_paths(self) -> Optional[PathsValidator]:
+        check_path = self.check_path
+        return lambda value: None if value is None else check_path(value)
+
 
 class DirEntry(StringEntry):
     """Description of directory path config entry"""
@@ -190,6 +353,17 @@ class DirEntry(StringEntry):
         res = super().check(value, environment)
         if res is not None:
             return res
+        return self.check_path(value)
+
+    def compile(self) -> Validator:
+        return self.compile_string(self.check_path, substitute=True)
+
+    def compile_paths(self) -> Optional[PathsValidator]:
+        check_path = self.check_path
+        return lambda value: None if value is None else check_path(value)
+
+    def check_path(self, value: str) -> Optional[str]:
+        """Check if directory exists, create it if allowed"""
         if not os.path.isdir(value):
             if self.exists:
                 return f'Directory "{value}" not found'
@@ -231,13 +405,52 @@ class ListEntry(ConfEntryBase):
         if length > self.max_length:
             return f'Length of "{self.name}" ({length}) is more than max ({self.max_length})'
         if length < self.min_length:
-            return f'Length of "{self.name}" ({length}) is less than min ({self.max_length})'
+            return f'Length of "{self.name}" ({length}) is less than min ({self.min_length})'
         for i in range(len(value)):
             value[i] = self.entry.pre_process(value[i], environment)
             res = self.entry.check(value[i], environment)
             if res is not None:
                 return res
 
+    def compile(self) -> Validator:
+        name, optional, default = self.name, self.optional, self.default
+        min_length, max_length, validate_item = self.min_length, self.max_length, self.entry.compile()
+
+        def validate(value, environment=None):
+            if value is None and optional:
+                value = default
+                if value is None:
+                    return value, None
+            if isinstance(value, tuple):
+                value = list(value)
+            if not isinstance(value, list):
+                return value, f'Type of "{name}" is {type(value)}, tuple or list expected'
+            length = len(value)
+            if length > max_length:
+                return value, f'Length of "{name}" ({length}) is more than max ({max_length})'
+            if length < min_length:
+                return value, f'Length of "{name}" ({length}) is less than min ({min_length})'
+            for i, item in enumerate(value):
+                value[i], res = validate_item(item, environment)
+                if res is not None:
+                    return value, res
+            return value, None
+
+        return validate
+
+    def compile_paths(self) -> Optional[PathsValidator]:
+        check_item = self.entry.compile_paths()
+        if check_item is None:
+            return None
+
+        def check_paths(value):
+            for item in (() if value is None else value):
+                res = check_item(item)
+                if res is not None:
+                    return res
+
+        return check_paths
+
 
 class DictEntry(ConfEntryBase):
     """Description of string config entry"""
@@ -270,13 +483,131 @@ class DictEntry(ConfEntryBase):
     def get_default(self):
         return {i.name: i.get_default() for i in self.entries if not i.optional}
 
+    def compile(self) -> Validator:
+        name, optional = self.name, self.optional
+        entries = tuple((i.name, not i.optional, i.get_default, i.compile()) for i in self.entries)
+
+        def validate(value, environment=None):
+            if value is None and optional:
+                return value, None
+            if not isinstance(value, dict):
+                return value, f'Type of "{name}" is {type(value)}, dictionary expected'
+            for key, required, get_default, validate_entry in entries:
+                item = value.get(key)
+                if item is None and required and key not in value:
+                    item = get_default()
+                value[key], res = validate_entry(item, environment)
+                if res is not None:
+                    return value, res
+            return value, None
+
+        return validate
+
+    def compile_paths(self) -> Optional[PathsValidator]:
+        entries = tuple((i.name, i.compile_paths()) for i in self.entries)
+        entries = tuple(i for i in entries if i[1] is not None)
+        if not entries:
+            return None
+
+        def check_paths(value):
+            if not isinstance(value, dict):
+                return
+            for key, check_entry in entries:
+                res = check_entry(value.get(key))
+                if res is not None:
+                    return res
+
+        return check_paths
+
+
+class CompiledSchema:
+    """Validators of schema compiled to closures and version of schema to key cached configs"""
+
+    def __init__(self, schema: ConfEntryBase):
+        self.validate = schema.compile()
+        self.check_paths = schema.compile_paths()
+        description = str(schema)
+        # Defaults may be random or depend on host, so they are not part of version
+        self.version = hashlib.sha1(f'{VALIDATORS_VERSION}\0{DEFAULT_LINE_PATTERN.sub("", description)}'
+                                    .encode()).hexdigest()
+        self.variables: Set[str] = set(ENV_VAR_PATTERN.findall(description))  # may be used in defaults
+
 
 class ConfigLoader:
-    """Loading and check facility for JSON configs, can also create default one"""
+    """Loading and check facility for JSON configs, can also create default one.
+    Validated configs are cached in files keyed by path, modification time, size and schema version.
+    Cache is used only if directory and files of it belong to current user and aren't accessible by others"""
+    CACHE_DIR_TEMPLATE = '$DCNNT_RUNTIME_DIR/conf_cache'
 
     def __init__(self, environment: Dict[str, str], path: str, schema: DictEntry, create_defult: bool):
         self.environment, self.path, self.schema, self.create_default = environment, path, schema, create_defult
 
+    @staticmethod
+    def private(st: os.stat_result) -> bool:
+        """Check if file or directory belongs to current user and isn't accessible by others"""
+        return st.st_uid == os.geteuid() and not st.st_mode & 0o077
+
+    def cache_path(self, create: bool = False) -> Optional[str]:
+        """Get path of file with cached config, None if cache directory is not defined or not private"""
+        directory = Template(self.CACHE_DIR_TEMPLATE).safe_substitute(self.environment)
+        if '$' in directory:
+            return None
+        try:
+            if create:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            st = os.lstat(directory)
+        except OSError:
+            return None
+        if not S_ISDIR(st.st_mode) or not self.private(st):  # may be created by other user in shared /tmp
+            return None
+        return os.path.join(directory, hashlib.sha1(os.path.abspath(self.path).encode()).hexdigest() + '.json')
+
+    def cache_key(self, stat: os.stat_result, compiled: CompiledSchema) -> list:
+        """Get data which must be same for cached and loaded config"""
+        return [os.path.abspath(self.path), stat.st_mtime_ns, stat.st_size, compiled.version]
+
+    def load_cached(self, stat: os.stat_result, compiled: CompiledSchema) -> Optional[dict]:
+        """Get validated config from cache, None if not cached or changed"""
+        path = self.cache_path()
+        if path is None:
+            return None
+        try:
+            with open(os.open(path, os.O_RDONLY | os.O_NOFOLLOW)) as f:
+                if not self.private(os.fstat(f.fileno())):
+                    return None
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('key') != self.cache_key(stat, compiled):
+            return None
+        variables, conf = cached.get('environment'), cached.get('conf')
+        if not isinstance(variables, dict) or not isinstance(conf, dict):
+            return None
+        if any(self.environment.get(k) != v for k, v in variables.items()):
+            return None
+        if compiled.check_paths is not None and compiled.check_paths(conf) is not None:
+            return None
+        return conf
+
+    def save_cached(self, stat: os.stat_result, compiled: CompiledSchema, text: str, conf: dict):
+        """Save validated config to cache with values of environment variables used in it"""
+        if time.time_ns() - stat.st_mtime_ns <= RACY_INTERVAL:
+            return
+        path = self.cache_path(True)
+        if path is None:
+            return
+        variables = compiled.variables.union(ENV_VAR_PATTERN.findall(text))
+        cached = dict(key=self.cache_key(stat, compiled), conf=conf,
+                      environment={i: self.environment.get(i) for i in sorted(variables)})
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600), 'w') as f:
+                f.write(json.dumps(cached))
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError):
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+
     def load(self) -> Union[dict, str]:
         """Load and check configuration, create default optionally"""
         if not os.path.isfile(self.path):
@@ -291,12 +622,20 @@ class ConfigLoader:
             else:
                 return f'File {self.path} not found'
         try:
-            conf = json.load(open(self.path))
+            compiled = self.schema.compiled()
+            stat = os.stat(self.path)
+            conf = self.load_cached(stat, compiled)
+            if conf is not None:
+                return conf
+            with open(self.path) as f:
+                text = f.read()
+            conf = json.loads(text)
             if not isinstance(conf, dict):
                 return f'JSON config file {self.path} must contain dictionary'
-            res = self.schema.check(conf, self.environment)
+            conf, res = compiled.validate(conf, self.environment)
             if res is not None:
                 return f'Error in configuration file {self.path}: {res}'
+            self.save_cached(stat, compiled, text, conf)
             return conf
         except IOError:
             return f'Could not open file {self.path}'
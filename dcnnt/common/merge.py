@@ -0,0 +1,66 @@
+"""Line-based merge of text file versions"""
+
+from difflib import SequenceMatcher
+from typing import List, Tuple, Dict, Sequence
+
+CONFLICT_START, CONFLICT_SEPARATOR, CONFLICT_END = b'<<<<<<< server\n', b'=======\n', b'>>>>>>> client\n'
+
+
+def _matches(base: Sequence[bytes], other: Sequence[bytes]) -> Dict[int, int]:
+    """Map indexes of base lines to indexes of same lines in other version"""
+    res = dict()
+    for a, b, size in SequenceMatcher(None, base, other, autojunk=False).get_matching_blocks():
+        for i in range(size):
+            res[a + i] = b + i
+    return res
+
+
+def _ensure_newline(lines: List[bytes]) -> List[bytes]:
+    """Add line break to the last line if absent, so conflict markers stay on separate lines"""
+    if lines and not lines[-1].endswith(b'\n'):
+        return lines[:-1] + [lines[-1] + b'\n']
+    return lines
+
+
+def merge3(base: Sequence[bytes], local: Sequence[bytes], remote: Sequence[bytes]) -> Tuple[List[bytes], bool]:
+    """Three-way merge of lines, return merged lines and conflict flag, conflicts are marked like in git"""
+    matches_local, matches_remote = _matches(base, local), _matches(base, remote)
+    res, conflict = list(), False
+    i = i_local = i_remote = 0
+    while True:
+        # Find next line of base unchanged in both versions
+        j = i
+        while j < len(base) and not (j in matches_local and j in matches_remote):
+            j += 1
+        if j < len(base):
+            j_local, j_remote = matches_local[j], matches_remote[j]
+        else:
+            j_local, j_remote = len(local), len(remote)
+        chunk_base, chunk_local, chunk_remote = base[i:j], local[i_local:j_local], remote[i_remote:j_remote]
+        if chunk_local == chunk_base or chunk_local == chunk_remote:
+            res.extend(chunk_remote)
+        elif chunk_remote == chunk_base:
+            res.extend(chunk_local)
+        else:
+            conflict = True
+            res.append(CONFLICT_START)
+            res.extend(_ensure_newline(list(chunk_local)))
+            res.append(CONFLICT_SEPARATOR)
+            res.extend(_ensure_newline(list(chunk_remote)))
+            res.append(CONFLICT_END)
+        if j >= len(base):
+            return res, conflict
+        res.append(base[j])
+        i, i_local, i_remote = j + 1, j_local + 1, j_remote + 1
+
+
+def append_dedupe(local: Sequence[bytes], remote: Sequence[bytes]) -> List[bytes]:
+    """Append lines of remote version absent in local version"""
+    res = _ensure_newline(list(local))
+    seen = set(i.rstrip(b'\r\n') for i in local)
+    for line in remote:
+        key = line.rstrip(b'\r\n')
+        if key not in seen:
+            seen.add(key)
+            res.append(line)
+    return res
@@ -0,0 +1,169 @@
+"""Cached listing of shared directories, directory is re-read only after modification of it or its files"""
+
+import os
+import time
+import fnmatch
+import itertools
+from threading import Lock
+from typing import Dict, Tuple, List, Set, Iterable
+
+# Directory entry: name, is directory, size, modification time in ns
+Entry = Tuple[str, bool, int, int]
+Listing = Tuple[Entry, ...]
+# Indexed file: key of shared directory, relative path parts, lowercase relative path, size, modification time in ns
+IndexedFile = Tuple[str, Tuple[str, ...], str, int, int]
+
+RACY_INTERVAL = 2000000000  # directories modified within this interval (ns) are not cached, mtime may not change
+
+
+class SharedTreeCache:
+    """Content of directories and lists of shared directories cached by modification time"""
+
+    def __init__(self):
+        self.dirs: Dict[str, Tuple[int, Listing]] = dict()
+        self.lists: Dict[str, Tuple[int, Tuple[str, ...]]] = dict()
+
+    @staticmethod
+    def scan(path: str) -> Listing:
+        """Read directory content sorted by name, entries neither files nor directories are skipped"""
+        entries = list()
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        entries.append((entry.name, True, 0, 0))
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        entries.append((entry.name, False, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    continue
+        entries.sort()
+        return tuple(entries)
+
+    @staticmethod
+    def files_unchanged(path: str, listing: Listing) -> bool:
+        """Check size and modification time of listed files, file rewritten in place doesn't change directory"""
+        for name, is_dir, size, mtime in listing:
+            if not is_dir:
+                try:
+                    stat = os.stat(os.path.join(path, name))
+                except OSError:
+                    return False
+                if stat.st_size != size or stat.st_mtime_ns != mtime:
+                    return False
+        return True
+
+    def listdir(self, path: str) -> Listing:
+        """Get directory content, re-read it if directory or its files changed since last call,
+        raise OSError on failure"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.dirs.get(path)
+        if cached is not None and cached[0] == mtime and self.files_unchanged(path, cached[1]):
+            return cached[1]
+        listing = self.scan(path)
+        if time.time_ns() - mtime > RACY_INTERVAL:
+            self.dirs[path] = mtime, listing
+        else:
+            self.dirs.pop(path, None)
+        return listing
+
+    def read_list(self, path: str) -> Tuple[str, ...]:
+        """Get lines of text file with list of shared directories, raise OSError on failure"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self.lists.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(path) as f:
+            lines = tuple(f.read().splitlines(keepends=False))
+        if time.time_ns() - mtime > RACY_INTERVAL:
+            self.lists[path] = mtime, lines
+        return lines
+
+    def invalidate(self, path: str):
+        """Drop cached content of directory"""
+        self.dirs.pop(path, None)
+
+
+def trigrams(text: str) -> Set[str]:
+    """Get set of all 3-character substrings of text"""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class SearchIndex:
+    """Trigram index of file paths in shared directories, only directories changed since last update are re-indexed"""
+    REFRESH_INTERVAL = 1.0  # min time in seconds between checks of one shared directory for changes
+
+    def __init__(self, cache: SharedTreeCache):
+        self.cache = cache
+        self.lock = Lock()
+        self.counter = itertools.count()
+        self.files: Dict[int, IndexedFile] = dict()
+        self.trigrams: Dict[str, Set[int]] = dict()
+        self.dirs: Dict[Tuple[str, Tuple[str, ...]], Tuple[Listing, Tuple[int, ...]]] = dict()
+        self.refreshed: Dict[str, float] = dict()
+
+    def add(self, key: str, parts: Tuple[str, ...], size: int, mtime: int) -> int:
+        """Add file to index, return its ID"""
+        file_id, text = next(self.counter), '/'.join(parts).lower()
+        self.files[file_id] = key, parts, text, size, mtime
+        for i in trigrams(text):
+            self.trigrams.setdefault(i, set()).add(file_id)
+        return file_id
+
+    def remove(self, file_id: int):
+        """Remove file from index"""
+        text = self.files.pop(file_id)[2]
+        for i in trigrams(text):
+            ids = self.trigrams.get(i)
+            if ids is not None:
+                ids.discard(file_id)
+                if not ids:
+                    del self.trigrams[i]
+
+    def update(self, key: str, path: str, glob: str, deep: int):
+        """Walk shared directory using cached listings and re-index directories changed since last update"""
+        now = time.monotonic()
+        if key in self.refreshed and now - self.refreshed[key] < self.REFRESH_INTERVAL:
+            return
+        self.refreshed[key] = now
+        seen, stack = set(), [()]
+        while stack:
+            parts = stack.pop()
+            directory = os.path.join(path, *parts)
+            try:
+                listing = self.cache.listdir(directory)
+            except OSError:
+                continue
+            seen.add(parts)
+            indexed = self.dirs.get((key, parts))
+            if indexed is None or indexed[0] is not listing:
+                for file_id in (() if indexed is None else indexed[1]):
+                    self.remove(file_id)
+                ids = tuple(self.add(key, parts + (name, ), size, mtime) for name, is_dir, size, mtime in listing
+                            if not is_dir and fnmatch.fnmatch(os.path.join(directory, name), glob))
+                self.dirs[(key, parts)] = listing, ids
+            if len(parts) + 1 < deep:
+                stack.extend(parts + (name, ) for name, is_dir, _, _ in listing if is_dir)
+        for dir_key in tuple(i for i in self.dirs if i[0] == key and i[1] not in seen):
+            for file_id in self.dirs.pop(dir_key)[1]:
+                self.remove(file_id)
+
+    def search(self, keys: Iterable[str], query: str) -> List[IndexedFile]:
+        """Find files of shared directories with all words of query in relative path, best matches first:
+        more words in file name, name starts with first word, less nested, shorter path"""
+        terms = query.lower().split()
+        if not terms:
+            return []
+        keys = set(keys)
+        sets = sorted((self.trigrams.get(i, set()) for term in terms for i in trigrams(term)), key=len)
+        candidates = set.intersection(*sets) if sets else self.files.keys()
+        res = [self.files[i] for i in candidates if self.files[i][0] in keys
+               and all(term in self.files[i][2] for term in terms)]
+
+        def rank(item: IndexedFile):
+            name = item[1][-1].lower()
+            return (-sum(term in name for term in terms), not name.startswith(terms[0]), len(item[1]), item[2],
+                    item[0])
+
+        res.sort(key=rank)
+        return res
@@ -0,0 +1,102 @@
+"""Downscaled previews of images with size-bounded disk cache, requires optional "Pillow" package"""
+
+import os
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
+from typing import Dict
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+THUMBNAIL_SUFFIX = '.jpg'
+
+
+def thumbnails_supported() -> bool:
+    """Check if imaging backend is installed"""
+    return Image is not None
+
+
+def make_thumbnail(src: str, dst: str, max_size: int):
+    """Save downscaled JPEG copy of image, both sides are not greater than max_size"""
+    with Image.open(src) as image:
+        image.draft('RGB', (max_size, max_size))  # fast downscale on decoding, JPEG only
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((max_size, max_size))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.save(dst, 'JPEG', quality=80, optimize=True)
+
+
+class ThumbnailCache:
+    """Thumbnails generated by pool of workers and stored in directory, least recently used are removed
+    when total size exceeds limit"""
+
+    def __init__(self, directory: str, max_bytes: int, workers: int):
+        self.directory, self.max_bytes = directory, max_bytes
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='Thread-Thumbnail')
+        self.lock = Lock()
+        self.pending: Dict[str, Future] = dict()
+        self.entries: Dict[str, int] = OrderedDict()  # file name -> size, least recently used first
+        self.total = 0
+        os.makedirs(directory, exist_ok=True)
+        found = list()
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.endswith(THUMBNAIL_SUFFIX) and entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total += size
+
+    def get(self, path: str, max_size: int) -> str:
+        """Get path to thumbnail of image, generate it if not cached yet"""
+        stat = os.stat(path)
+        key = hashlib.sha1(f'{path}\0{stat.st_mtime_ns}\0{stat.st_size}\0{max_size}'.encode()).hexdigest()
+        name = key + THUMBNAIL_SUFFIX
+        thumbnail_path = os.path.join(self.directory, name)
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                try:
+                    os.utime(thumbnail_path)  # keep recently used on restart
+                    return thumbnail_path
+                except OSError:  # removed outside
+                    self.total -= self.entries.pop(name)
+            future = self.pending.get(name)
+            if future is None:
+                future = self.pending[name] = self.executor.submit(self.create, path, name, max_size)
+        return future.result()
+
+    def create(self, path: str, name: str, max_size: int) -> str:
+        """Generate thumbnail and add it to cache"""
+        thumbnail_path = os.path.join(self.directory, name)
+        temp_path = f'{thumbnail_path}.{os.getpid()}.tmp'
+        try:
+            make_thumbnail(path, temp_path, max_size)
+            os.replace(temp_path, thumbnail_path)
+            size = os.path.getsize(thumbnail_path)
+            with self.lock:
+                self.entries[name] = size
+                self.total += size
+                self.evict()
+            return thumbnail_path
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            with self.lock:
+                self.pending.pop(name, None)
+
+    def evict(self):
+        """Remove least recently used thumbnails while cache is too big, the last added one is kept"""
+        while self.total > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total -= size
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
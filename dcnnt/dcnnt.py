@@ -2,23 +2,45 @@
 import os
 import sys
 import argparse
+import importlib
 
-from .app import DConnectApp
+from .timing import StartupProfile
+
+CORE_MODULES = '.common', '.device_manager', '.hooks', '.server_search', '.tcp_server', '.plugins', '.app'
 
 
 def main():
+    profile = StartupProfile()
+    for module in CORE_MODULES:
+        with profile.stage(f'import {module[1:]}'):
+            importlib.import_module(module, __package__)
+    from .app import DConnectApp
     parser = argparse.ArgumentParser()
     parser.add_argument('--doc', help='Print conf doc and exit', action='store_true')
     parser.add_argument('-c', '--configuration-directory', help='Path to configuration directory',
                         default=os.path.join(os.environ['HOME'], '.config', 'dcnnt'))
     parser.add_argument('--pairing-code', help='Set pre-defined pairing code')
-    parser.add_argument('mode', choices=('doc', 'foreground', 'fg', 'pair', 'start', 'stop', 'restart'),
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='Start app in current tty, print import and init time of components '
+                             'when all plugins are loaded and exit')
+    parser.add_argument('mode', choices=('doc', 'foreground', 'fg', 'pair', 'start', 'stop', 'restart',
+                                         'import-devices', 'export-devices'),
                         nargs='?', default='start',
                         help='Mode to run program: doc - just print config documentation and exit, '
                              'foreground (short: fg) - run program in current tty, '
-                             'start/stop/restart - run and stop program as daemon')
+                             'start/stop/restart - run and stop program as daemon, '
+                             'import-devices/export-devices - copy devices from JSON files to registry database '
+                             'and back')
     args = parser.parse_args(sys.argv[1:])
-    if args.mode == 'doc':
+    if args.profile_startup:
+        app = DConnectApp(args.configuration_directory, True, profile)
+        app.init()
+        app.run()
+        if app.plugins_thread is not None:
+            app.plugins_thread.join()
+        print(profile.report())
+        app.shutdown()
+    elif args.mode == 'doc':
         print(str(DConnectApp.CONFIG_SCHEMA))
         print(DConnectApp.CONFIG_SCHEMA.get_default())
     elif args.mode in {'foreground', 'fg'}:
@@ -38,6 +60,10 @@ def main():
         elif args.mode == 'pair':
             app.check()
             app.pair(args.pairing_code)
+        elif args.mode == 'import-devices':
+            print(f'{app.import_devices()} devices imported to registry database')
+        elif args.mode == 'export-devices':
+            print(f'{app.export_devices()} devices exported to JSON files')
         elif args.mode == 'stop':
             pid = app.stop()
             if pid:
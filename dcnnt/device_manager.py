@@ -1,6 +1,10 @@
 """Management of known devices and their authentication data"""
 
 import fnmatch
+import sqlite3
+from contextlib import closing
+from threading import Lock, Timer
+from typing import Set, List, Iterable
 
 from .common import derive_key
 from .common.jsonconf import *
@@ -8,15 +12,32 @@ from .common.jsonconf import *
 
 class Device:
     """Known device representation, using to manage preferences device info and key"""
+    __slots__ = 'uin', 'name', 'description', 'role', 'password', 'ip', '_app_auth', '_key_send', '_key_recv'
 
     def __init__(self, uin, name, description='', role='client', password=None):
         self.uin, self.name, self.description, self.role, self.password = uin, name, description, role, password
-        self.key_send = self.key_recv = self.ip = None
+        self.ip = self._app_auth = self._key_send = self._key_recv = None
 
     def init_keys(self, app_uin, app_password):
-        """Init both encrypt end decrypt keys for device"""
-        self.key_recv = derive_key(''.join(map(str, (app_uin, self.uin, app_password, self.password))))
-        self.key_send = derive_key(''.join(map(str, (self.uin, app_uin, self.password, app_password))))
+        """Init both encrypt end decrypt keys for device, keys are derived on first use"""
+        self._app_auth = app_uin, app_password
+        self._key_send = self._key_recv = None
+
+    @property
+    def key_recv(self) -> Optional[bytes]:
+        """Key to decrypt data received from device"""
+        if self._key_recv is None and self._app_auth is not None:
+            app_uin, app_password = self._app_auth
+            self._key_recv = derive_key(''.join(map(str, (app_uin, self.uin, app_password, self.password))))
+        return self._key_recv
+
+    @property
+    def key_send(self) -> Optional[bytes]:
+        """Key to encrypt data sent to device"""
+        if self._key_send is None and self._app_auth is not None:
+            app_uin, app_password = self._app_auth
+            self._key_send = derive_key(''.join(map(str, (self.uin, app_uin, self.password, app_password))))
+        return self._key_send
 
     def dict(self):
         """Get dictionary to dump to JSON file"""
@@ -26,6 +47,33 @@ class Device:
         return 'Device(UIN={}, name={}, role={}, password={})'.format(self.uin, self.name, self.role, self.password)
 
 
+class SqliteRegistry:
+    """Known devices stored in single SQLite database file"""
+    FIELDS = 'uin', 'name', 'description', 'role', 'password'
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        with self.connect() as db, db:
+            db.execute('CREATE TABLE IF NOT EXISTS devices (uin INTEGER PRIMARY KEY, name TEXT NOT NULL, '
+                       'description TEXT, role TEXT, password TEXT)')
+
+    def connect(self):
+        """Open new database connection, it is closed on exit from context"""
+        return closing(sqlite3.connect(self.path))
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Get data of all devices"""
+        with self.connect() as db:
+            return [dict(zip(self.FIELDS, row)) for row in db.execute(f'SELECT {", ".join(self.FIELDS)} FROM devices')]
+
+    def save(self, devices: Iterable[Device]):
+        """Insert or update devices in one transaction"""
+        rows = tuple(tuple(map(device.dict().get, self.FIELDS)) for device in devices)
+        with self.lock, self.connect() as db, db:
+            db.executemany(f'INSERT OR REPLACE INTO devices ({", ".join(self.FIELDS)}) VALUES (?, ?, ?, ?, ?)', rows)
+
+
 class DeviceManager(dict):
     """Object to control list of known devices"""
     JSON_SCHEMA = DictEntry('*.device.json', 'Device description and login data', True, entries=(
@@ -36,18 +84,29 @@ class DeviceManager(dict):
         StringEntry('password', 'Access password', True, 0, 4096, ''),
     ))
     FILENAME_TEMPLATE = '{}.device.json'
+    REGISTRY_FILENAME = 'devices.sqlite'
+    WRITE_DELAY = 5.0  # seconds to wait before saving changed devices
 
-    def __init__(self, app, directory):
+    def __init__(self, app, directory, registry: Optional[SqliteRegistry] = None):
         super().__init__()
-        self.app, self.log, self.directory = app, app.log, directory
+        self.app, self.log, self.directory, self.registry = app, app.log, directory, registry
+        self.unsaved: Set[int] = set()
+        self.unsaved_lock = Lock()
+        self.write_timer: Optional[Timer] = None
 
     def find_files(self, directory):
         """Find files in directory self.directory by wildcard"""
         return fnmatch.filter(os.listdir(directory), self.FILENAME_TEMPLATE.format('*'))
 
-    def load(self):
-        """Load all items using self.directory to search"""
-        if os.path.isdir(self.directory):
+    def load(self, app_device: Optional[Device] = None):
+        """Load all items from registry or files in self.directory, keys are derived using app device"""
+        app_device = self.app.dev if app_device is None else app_device
+        if self.registry is not None:
+            for device_dict in self.registry.load():
+                device = self[device_dict['uin']] = Device(**device_dict)
+                device.init_keys(app_device.uin, app_device.password)
+            self.log.info(f'Loaded {len(self)} devices from "{self.registry.path}"')
+        elif os.path.isdir(self.directory):
             file_list = self.find_files(self.directory)
             for filename in file_list:
                 path = os.path.join(self.directory, filename)
@@ -55,7 +114,7 @@ class DeviceManager(dict):
                 uin_item_pair = self.load_item(path)
                 if uin_item_pair:
                     self[uin_item_pair[0]] = uin_item_pair[1]
-                    uin_item_pair[1].init_keys(self.app.dev.uin, self.app.dev.password)
+                    uin_item_pair[1].init_keys(app_device.uin, app_device.password)
                 else:
                     self.log.warning("Couldn't load device data from file '{}'".format(filename))
         else:
@@ -73,18 +132,55 @@ class DeviceManager(dict):
             return device_dict['uin'], Device(**device_dict)
         self.log.warning(device_dict)
 
-    def dump_device(self, device):
+    def dump_device_file(self, device):
         """Save device to JSON file, using self.directory and DEVICE_FILENAME_TEMPLATE as path (WARN: plaintext pswd)"""
         filename = self.FILENAME_TEMPLATE.format(device.uin)
         path = os.path.join(self.directory, filename)
-        with open(path, 'w') as f:
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w') as f:
             json.dump(device.dict(), f, sort_keys=True, indent=2)
+        os.replace(temp_path, path)
+
+    def dump_device(self, device):
+        """Save device to registry or JSON file at once"""
+        if self.registry is not None:
+            self.registry.save((device, ))
+        else:
+            self.dump_device_file(device)
 
     def dump(self):
         """Dump all devices to files in directory self.directory"""
         for address, device in self.items():
             self.dump_device(device)
 
+    def save_later(self, device):
+        """Save device after WRITE_DELAY with other changed devices"""
+        with self.unsaved_lock:
+            self.unsaved.add(device.uin)
+            if self.write_timer is None:
+                self.write_timer = Timer(self.WRITE_DELAY, self.flush)
+                self.write_timer.daemon = True
+                self.write_timer.start()
+
+    def flush(self):
+        """Save changed devices"""
+        with self.unsaved_lock:
+            uins, self.unsaved = self.unsaved, set()
+            if self.write_timer is not None:
+                self.write_timer.cancel()
+                self.write_timer = None
+        devices = tuple(self[i] for i in uins if i in self)
+        if not devices:
+            return
+        try:
+            if self.registry is not None:
+                self.registry.save(devices)
+            else:
+                for device in devices:
+                    self.dump_device_file(device)
+        except (OSError, sqlite3.Error) as e:
+            self.log.error(f'Could not save devices: {e}')
+
     def update_device_password(self, uin, password):
         """Update current password for device and re-generate keys"""
         device = self.get(uin)
@@ -96,14 +192,14 @@ class DeviceManager(dict):
         return False
 
     def update_device(self, uin, ip, name=None, role=None):
-        """Update current network address for known device or add new device"""
+        """Update current network address for known device or add new device, new device is saved with delay"""
         device = self.get(uin)
         if device is None:
             self.log.info("New device found. UIN: '{}', IP: '{}'".format(uin, ip))
             if isinstance(name, str) and isinstance(role, str):
                 device = self[uin] = Device(uin=uin, name=name, role=role)
                 device.ip = ip
-                self.dump_device(device)
+                self.save_later(device)
             else:
                 self.log.error('No role or name presented for new device')
         else:
@@ -0,0 +1,132 @@
+"""Execution of shell commands invoked on events (on_done, on_download, etc) out of connection threads"""
+
+import os
+import time
+import signal
+import subprocess
+from queue import Queue
+from logging import Logger
+from collections import deque
+from threading import Thread, Condition, Lock
+from typing import Dict, List, Optional, Callable, Any, Deque
+
+
+class HookExecutor:
+    """Run hook commands in bounded pool of workers, limit concurrency and time of commands, coalesce bursts"""
+
+    def __init__(self, log: Logger, environment: Dict[str, str], workers: int, timeout: int, concurrency: int,
+                 debounce: int):
+        self.log, self.environment = log, environment
+        self.workers, self.timeout, self.concurrency, self.debounce = workers, timeout, concurrency, debounce / 1000
+        self.queue: Queue = Queue()
+        # Count of running commands and runs waiting for end of one of them by key, worker never waits for limit
+        self.running: Dict[str, int] = dict()
+        self.waiting: Dict[str, Deque[tuple]] = dict()
+        self.limits_lock = Lock()
+        # Delayed runs waiting for burst end: key -> [command, paths, deadline, cleanups]
+        self.pending: Dict[str, list] = dict()
+        self.pending_cond = Condition()
+        self.threads: List[Thread] = list()
+
+    def start(self) -> 'HookExecutor':
+        """Start worker threads"""
+        for i in range(self.workers):
+            self.threads.append(Thread(target=self.worker, name=f'Thread-Hook-{i}', daemon=True))
+        self.threads.append(Thread(target=self.dispatcher, name='Thread-Hook-Dispatcher', daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def submit(self, key: str, command: str, path: Optional[str] = None, coalesce: bool = True,
+               cleanup: Optional[Callable[[], Any]] = None):
+        """Schedule command run, key is unformatted template of command using to group runs.
+        Runs of same key in burst coalesced into one run of last command with all paths in $DCNNT_HOOK_PATHS.
+        Cleanup function (to remove temporary file, etc) is called when command exited"""
+        paths = [] if path is None else [path]
+        cleanups = [] if cleanup is None else [cleanup]
+        if not coalesce or self.debounce <= 0:
+            self.queue.put((key, command, paths, cleanups))
+            return
+        with self.pending_cond:
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [command, paths, time.monotonic() + self.debounce, cleanups]
+            else:
+                entry[0] = command
+                entry[1].extend(paths)
+                entry[2] = time.monotonic() + self.debounce
+                entry[3].extend(cleanups)
+            self.pending_cond.notify()
+
+    def dispatcher(self):
+        """Move coalesced runs to queue when burst is over"""
+        with self.pending_cond:
+            while True:
+                now = time.monotonic()
+                for key, (command, paths, deadline, cleanups) in tuple(self.pending.items()):
+                    if deadline <= now:
+                        del self.pending[key]
+                        self.queue.put((key, command, paths, cleanups))
+                timeout = min((i[2] for i in self.pending.values()), default=now + 60) - now
+                self.pending_cond.wait(max(timeout, 0))
+
+    def acquire(self, item: tuple) -> bool:
+        """Count run of command if concurrency limit of its key allows it, otherwise defer it until end of
+        running one"""
+        key = item[0]
+        with self.limits_lock:
+            running = self.running.get(key, 0)
+            if running >= self.concurrency:
+                self.waiting.setdefault(key, deque()).append(item)
+                return False
+            self.running[key] = running + 1
+            return True
+
+    def release(self, key: str):
+        """Count end of command run, queue next deferred run of the same key"""
+        with self.limits_lock:
+            self.running[key] -= 1
+            if not self.running[key]:
+                del self.running[key]
+            waiting = self.waiting.get(key)
+            if waiting:
+                self.queue.put(waiting.popleft())
+                if not waiting:
+                    del self.waiting[key]
+
+    def worker(self):
+        """Take commands from queue and run them"""
+        while True:
+            item = self.queue.get()
+            if not self.acquire(item):
+                continue
+            key, command, paths, cleanups = item
+            try:
+                self.run(command, paths)
+            except Exception as e:
+                self.log.exception(e)
+            finally:
+                self.release(key)
+            for cleanup in cleanups:
+                try:
+                    cleanup()
+                except Exception as e:
+                    self.log.exception(e)
+
+    def run(self, command: str, paths: List[str]):
+        """Run command in shell, kill whole process group on timeout"""
+        if len(paths) > 1:
+            self.log.info(f'Execute: "{command}" (coalesced {len(paths)} runs)')
+        else:
+            self.log.info(f'Execute: "{command}"')
+        env = dict(self.environment, DCNNT_HOOK_PATHS='\n'.join(paths))
+        process = subprocess.Popen(command, shell=True, env=env, start_new_session=True)
+        try:
+            code = process.wait(self.timeout or None)
+        except subprocess.TimeoutExpired:
+            self.log.warning(f'Command timeout ({self.timeout} s), kill: "{command}"')
+            os.killpg(process.pid, signal.SIGKILL)
+            process.wait()
+        else:
+            if code:
+                self.log.warning(f'Command exit code {code}: "{command}"')
@@ -1,10 +1,83 @@
-from .base import PluginInitializer
-from .file_transfer import FileTransferPlugin
-from .remote_commands import RemoteCommandsPlugin
-from .notifications import NotificationsPlugin
-from .opener import OpenerPlugin
-from .sync import SyncPlugin
-from .clipboard import ClipboardPlugin
+"""Plugins registered by MARK, plugin module is imported and configured on first use"""
 
+import importlib
+from logging import Logger
+from threading import Lock
+from typing import Dict, Tuple, Type, Optional
 
-PLUGINS = FileTransferPlugin, OpenerPlugin, RemoteCommandsPlugin, NotificationsPlugin, SyncPlugin, ClipboardPlugin
+from .base import PluginInitializer, Plugin
+from ..timing import StartupProfile
+
+PLUGIN_MODULES: Dict[bytes, Tuple[str, str]] = {
+    b'file': ('file_transfer', 'FileTransferPlugin'),
+    b'open': ('opener', 'OpenerPlugin'),
+    b'rcmd': ('remote_commands', 'RemoteCommandsPlugin'),
+    b'nots': ('notifications', 'NotificationsPlugin'),
+    b'sync': ('sync', 'SyncPlugin'),
+    b'clip': ('clipboard', 'ClipboardPlugin'),
+}
+
+
+def plugin_class(mark: bytes) -> Type[Plugin]:
+    """Import plugin module and get plugin class, raise ImportError on failure"""
+    module, name = PLUGIN_MODULES[mark]
+    return getattr(importlib.import_module(f'.{module}', __name__), name)
+
+
+def __getattr__(name):
+    """Import plugin class on access by name"""
+    for mark, (_, class_name) in PLUGIN_MODULES.items():
+        if class_name == name:
+            return plugin_class(mark)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+class PluginRegistry:
+    """Initialized plugin classes by MARK, plugin is initialized on first request or by load_all call"""
+
+    def __init__(self, environment, plugin_dir: str, log: Logger, profile: StartupProfile,
+                 plugins: Optional[Dict[bytes, Optional[Type[Plugin]]]] = None):
+        self.environment, self.plugin_dir, self.log, self.profile = environment, plugin_dir, log, profile
+        self.plugins: Dict[bytes, Optional[Type[Plugin]]] = dict() if plugins is None else plugins
+        self.locks = {mark: Lock() for mark in PLUGIN_MODULES}
+        self.stopped = False
+
+    def init_plugin(self, mark: bytes) -> Optional[Type[Plugin]]:
+        """Import plugin and load its configuration, return None on failure"""
+        module = PLUGIN_MODULES[mark][0]
+        try:
+            with self.profile.stage(f'import plugin {module}'):
+                cls = plugin_class(mark)
+        except ImportError as e:
+            self.log.error(f'Plugin module "{module}" import fail: {e}')
+            return None
+        with self.profile.stage(f'init plugin {module}'):
+            ok = PluginInitializer(self.environment, self.plugin_dir, self.log, cls).init_plugin()
+        return cls if ok else None
+
+    def get(self, mark: bytes, default=None) -> Optional[Type[Plugin]]:
+        """Get plugin class, initialize it if not done yet"""
+        if mark not in self.plugins:
+            lock = self.locks.get(mark)
+            if lock is None or self.stopped:
+                return default
+            with lock:
+                if mark not in self.plugins:
+                    self.plugins[mark] = self.init_plugin(mark)
+        plugin = self.plugins[mark]
+        return default if plugin is None else plugin
+
+    def load_all(self):
+        """Initialize all plugins not initialized yet"""
+        for mark in PLUGIN_MODULES:
+            if self.stopped:
+                return
+            self.get(mark)
+
+    def stop(self):
+        """Stop initialization of plugins, registry is going to be replaced with new one"""
+        self.stopped = True
+
+    def __contains__(self, mark: bytes) -> bool:
+        """Check if plugin is initialized successfully, initialization isn't started"""
+        return self.plugins.get(mark) is not None
@@ -1,8 +1,17 @@
 import glob
+import mmap
+import secrets
+from stat import S_ISREG, S_IMODE, S_IWUSR, S_IWGRP, S_IWOTH
 from abc import ABC
+from queue import Queue, Full
+from threading import Thread, Event
+from types import MappingProxyType
+from io import BytesIO
+from typing import List, Tuple, Iterator, BinaryIO, Mapping
 from logging import Logger, DEBUG, INFO, WARNING, ERROR
 
 from ..common import *
+from ..common.compression import open_compressed, compression_suffix
 
 
 class PluginInitializer:
@@ -11,33 +20,80 @@ class PluginInitializer:
     def __init__(self, environment, plugin_dir, log, cls):
         self.environment, self.plugin_dir, self.log, self.cls = environment, plugin_dir, log, cls
 
-    def init_plugin(self):
-        """Load plugin configurations and set up class to using in app"""
+    def load(self) -> Optional[Tuple[Dict[str, Any], Dict[int, Dict[str, Any]]]]:
+        """Load and validate main and device-specific plugin configurations"""
         name = self.cls.NAME
         mark = self.cls.MARK.decode('ascii')
         main_conf_path = os.path.join(self.plugin_dir, '{}.conf.json'.format(mark))
         res = ConfigLoader(self.environment, main_conf_path, self.cls.CONFIG_SCHEMA, True).load()
         if isinstance(res, str):
             self.log.error(f'Plugin "{name}" init fail: {res}')
-            return False
-        self.cls.MAIN_CONF = res
+            return None
+        main_conf, device_confs = res, dict()
         for path in glob.glob(os.path.join(self.plugin_dir, '*.{}.conf.json'.format(mark))):
             res = ConfigLoader(self.environment, path, self.cls.CONFIG_SCHEMA, False).load()
             if isinstance(res, str):
                 self.log.warning(f'Plugin "{name}" dev conf fail: {res}')
             else:
                 if res.get('device') is not None:
-                    self.cls.DEVICE_CONFS[res['device']] = res
+                    device_confs[res['device']] = res
                 else:
                     self.log.warning(f'Plugin "{name}" dev conf fail: no UIN set in device config')
+        return main_conf, device_confs
+
+    def apply(self, main_conf: Dict[str, Any], device_confs: Dict[int, Dict[str, Any]]):
+        """Set plugin configuration, already running plugin instances keep using previous one"""
+        contexts = self.cls.build_contexts(main_conf, device_confs)
+        self.cls.MAIN_CONF, self.cls.DEVICE_CONFS, self.cls.CONTEXTS = main_conf, device_confs, contexts
+
+    def init_plugin(self):
+        """Load plugin configurations and set up class to using in app"""
+        confs = self.load()
+        if confs is None:
+            return False
+        self.apply(*confs)
         try:
             return self.cls.post_init()
         except Exception as e:
-            self.log.error('Initialization error for plugin {}'.format(name))
+            self.log.error('Initialization error for plugin {}'.format(self.cls.NAME))
             self.log.exception(e)
         return False
 
 
+def freeze(value: Any) -> Any:
+    """Get read-only copy of config value: dictionaries as mapping proxies and lists as tuples"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(i) for i in value)
+    return value
+
+
+class PluginContext:
+    """Plugin configuration of device compiled once and shared by all connections of this device,
+    configuration is read-only copy, so values returned by lookup may not be changed by connections"""
+
+    def __init__(self, conf: Dict[str, Any]):
+        self.conf: Mapping[str, Any] = freeze(conf)
+        self.values: Dict[tuple, Any] = dict()
+
+    def lookup(self, path: tuple) -> Any:
+        """Get value from config using key sequence, found values are cached"""
+        try:
+            return self.values[path]
+        except KeyError:
+            pass
+        node = self.conf
+        for i in path:
+            try:
+                node = node[i]
+            except (KeyError, IndexError):
+                node = None
+                break
+        self.values[path] = node
+        return node
+
+
 class HandlerExit(Exception):
     """Raising of this exception causes RPC handler exit and normal response sending"""
 
@@ -70,9 +126,12 @@ class Plugin:
     DEFAULT_CONF = dict(device=None)
     MAIN_CONF = dict()
     DEVICE_CONFS = dict()
+    CONTEXT_CLASS = PluginContext
+    CONTEXTS: Dict[Optional[int], PluginContext] = dict()
 
     def __init__(self, app, handler, device):
         self.app, self.logger, self.handler, self.sock, self.device = app, app.log, handler, handler.sock, device
+        self.context = self.get_context(device.uin)
 
     def log(self, message, level: int = INFO):
         """Make log record with specified level"""
@@ -83,23 +142,39 @@ class Plugin:
         """Plugin-specific initialization, this function is called by plugin manager in the end of plugin init"""
         return True
 
+    @classmethod
+    def build_contexts(cls, main_conf: Dict[str, Any], device_confs: Dict[int, Dict[str, Any]]) \
+            -> Dict[Optional[int], PluginContext]:
+        """Compile main and device-specific configurations to context objects"""
+        contexts = {None: cls.CONTEXT_CLASS(main_conf)}
+        contexts.update((uin, cls.CONTEXT_CLASS(conf)) for uin, conf in device_confs.items())
+        return contexts
+
+    @classmethod
+    def compile_contexts(cls):
+        """Compile current configurations of plugin class to context objects"""
+        cls.CONTEXTS = cls.build_contexts(cls.MAIN_CONF, cls.DEVICE_CONFS)
+
+    @classmethod
+    def get_context(cls, uin: Optional[int]) -> PluginContext:
+        """Get compiled context for device, main one if there is no device-specific config"""
+        context = cls.CONTEXTS.get(uin)
+        if context is None:
+            context = cls.CONTEXTS.get(None)
+        if context is None:
+            cls.compile_contexts()
+            context = cls.CONTEXTS.get(uin, cls.CONTEXTS[None])
+        return context
+
     def conf(self, path):
         """Get value from config using path - key or key sequence.
         If uin is integer - try get from device-specific conf"""
-        uin = self.device.uin
-        conf = self.DEVICE_CONFS.get(uin, self.MAIN_CONF)
         if not isinstance(path, (tuple, list)):
             path = (path, )
-        node = conf
-        for i in path:
-            try:
-                node = node[i]
-            except (KeyError, IndexError):
-                return
-            except TypeError:
-                self.log('TypeError in plugin {} while config value {}'.format(self.NAME, path), ERROR)
-                return
-        return node
+        try:
+            return self.context.lookup(tuple(path))
+        except TypeError:
+            self.log('TypeError in plugin {} while config value {}'.format(self.NAME, path), ERROR)
 
     def read(self) -> Optional[bytes]:
         """Read message from socket"""
@@ -130,13 +205,15 @@ class Plugin:
             self.log(e, WARNING)
 
     def rpc_send(self, obj: RPCObject):
-        """Send JSON-RPC 2.0 response, notification or request"""
+        """Send JSON-RPC 2.0 response, notification or request, return False if sending failed"""
         try:
             serialized_obj = json.dumps(obj.to_dict())
             self.send(serialized_obj.encode())
             self.log("Sent: {}".format(serialized_obj), DEBUG)
         except BaseException as e:
             self.log(e, WARNING)
+            return False
+        return True
 
     def process_request(self, request: RPCRequest):
         """Process one RPC request"""
@@ -169,39 +246,146 @@ class Plugin:
 class BaseFilePlugin(Plugin, ABC):
     """Common option for files with file transfer support"""
     PART = 65532
+    READ_AHEAD = 64  # count of chunks prefetched while sending files batch
+    CACHE_DROP_WINDOW = 8388608  # sent file data is dropped from page cache by blocks of this size
+
+    def __init__(self, app, handler, device):
+        super().__init__(app, handler, device)
+        self.received: List[str] = list()  # files to flush on session end
+
+    def main(self):
+        try:
+            super().main()
+        finally:
+            self.sync_received()
+
+    def _receive_data(self, request: RPCRequest, size: int, f: BinaryIO) -> int:
+        """Receive file data from client device and write it to file object"""
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK')))
+        wrote = 0
+        while wrote < size:
+            buf = self.read()
+            if buf is None:
+                raise HandlerFail(f'File receiving aborted ({wrote} bytes received)')
+            if len(buf) == 0:
+                req = self.rpc_read()
+                if req.method == "cancel":
+                    raise HandlerExit.new(request, 1, 'Canceled')
+            wrote += len(buf)
+            f.write(buf)
+        self.log(f'File received ({wrote} bytes)', INFO)
+        return wrote
 
-    def _receive_file(self, request: RPCRequest, download_directory: str, path: Optional[str]) -> str:
-        """Receive and save file from client device"""
+    @staticmethod
+    def _preallocate(fd: int, size: int):
+        """Reserve disk space for file to avoid fragmentation if supported by platform and file system"""
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _fsync(path: str):
+        """Flush file or directory to disk"""
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def _copy_mode(path: str, temp_path: str):
+        """Set permissions and owner of existing target file to temporary file replacing it"""
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        os.chmod(temp_path, S_IMODE(stat.st_mode))
+        try:
+            os.chown(temp_path, stat.st_uid, stat.st_gid)
+        except PermissionError:
+            pass
+
+    def _receive_file(self, request: RPCRequest, download_directory: str, path: Optional[str],
+                      compression: Optional[str] = None, before_replace: Optional[Callable[[str], Any]] = None) -> str:
+        """Receive and save file from client device, compress it on the fly optionally.
+        Data written to temporary file in the same directory, renamed to target path on success only,
+        before_replace is called with target path just before renaming. Temporary file gets permissions
+        and owner of existing target file, symbolic link target is replaced by file it points to"""
         try:
             name, size = request.params['name'], request.params['size']
         except KeyError as e:
             raise HandlerFail(f'KeyError {e}')
         path = os.path.join(download_directory, name) if path is None else path
+        path += compression_suffix(compression)
+        if os.path.islink(path):  # update file linked, not replace link
+            path = os.path.realpath(path)
+        directory, filename = os.path.split(path)
+        temp_path = os.path.join(directory, f'.{filename}.{secrets.token_hex(4)}.part')
+        fsync = self.app.conf.get('fsync', 'none')
         self.log(f'Receiving {size} bytes to file {path}')
-        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK')))
-        wrote = 0
-        with open(path, 'wb') as f:
-            while wrote < size:
-                buf = self.read()
-                if buf is None:
-                    raise HandlerFail(f'File receiving aborted ({wrote} bytes received)')
-                if len(buf) == 0:
-                    req = self.rpc_read()
-                    if req.method == "cancel":
-                        raise HandlerExit.new(request, 1, 'Canceled')
-                wrote += len(buf)
-                f.write(buf)
-        self.log(f'File received ({wrote} bytes)', INFO)
+        try:
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            if compression is None:
+                self._preallocate(fd, size)
+                f = open(fd, 'wb', buffering=self.PART)
+            else:
+                os.close(fd)
+                f = open_compressed(temp_path, 'wb', compression)
+            with f:
+                wrote = self._receive_data(request, size, f)
+                if compression is None and wrote != size:
+                    f.flush()
+                    os.ftruncate(f.fileno(), wrote)
+            self._copy_mode(path, temp_path)
+            if fsync == 'file':
+                self._fsync(temp_path)
+            if before_replace is not None:
+                before_replace(path)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        if fsync == 'file':
+            self._fsync(directory or '.')
+        elif fsync == 'session':
+            self.received.append(path)
         self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK')))
         return path
 
+    def sync_received(self):
+        """Flush files received in session and their directories to disk"""
+        for path in tuple(self.received) + tuple({os.path.dirname(i) or '.' for i in self.received}):
+            try:
+                self._fsync(path)
+            except OSError as e:
+                self.log(f'Could not flush "{path}": {e}', WARNING)
+        if self.received:
+            self.log(f'Flushed {len(self.received)} received files to disk')
+        self.received.clear()
+
+    def receive_file_to_buffer(self, request: RPCRequest) -> bytes:
+        """Receive file from client device to memory"""
+        try:
+            size = request.params['size']
+        except KeyError as e:
+            raise HandlerFail(f'KeyError {e}')
+        self.log(f'Receiving {size} bytes to memory')
+        buf = BytesIO()
+        self._receive_data(request, size, buf)
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK')))
+        return buf.getvalue()
+
     def receive_file_to_path(self, request: RPCRequest, path: str) -> str:
         """Receive and save file from client device to path"""
         return self._receive_file(request, '', path)
 
-    def receive_file(self, request: RPCRequest, download_directory: str) -> str:
+    def receive_file(self, request: RPCRequest, download_directory: str, compression: Optional[str] = None,
+                     before_replace: Optional[Callable[[str], Any]] = None) -> str:
         """Receive and save file from client device to directory"""
-        return self._receive_file(request, download_directory, None)
+        return self._receive_file(request, download_directory, None, compression, before_replace)
 
     def send_file(self, request: RPCRequest, path: str, size: Optional[int] = None):
         """Common function to send file to client"""
@@ -217,10 +401,148 @@ class BaseFilePlugin(Plugin, ABC):
         self.rpc_send(RPCResponse(request.id, result_init))
         with open(path, 'rb') as f:
             self.log('Start file transmission')
-            while True:
-                chunk = f.read(self.PART)
-                if len(chunk) == 0:
-                    break
+            for chunk in self._file_chunks(f):
                 self.send(chunk)
                 # self.log('Sent {} bytes...'.format(len(chunk)))
 
+    @staticmethod
+    def _fadvise(fd: int, offset: int, length: int, advice: str):
+        """Give file access pattern hint to OS if supported for platform and file"""
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(fd, offset, length, getattr(os, advice))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _map_file(fd: int) -> Optional[mmap.mmap]:
+        """Map file to memory if it is safe: truncation of mapped file while sending causes SIGBUS and kills process,
+        so only regular files without write permissions are mapped. None if file is not mapped"""
+        mode = os.fstat(fd).st_mode
+        if not S_ISREG(mode) or mode & (S_IWUSR | S_IWGRP | S_IWOTH):
+            return None
+        try:
+            return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return None
+
+    def _file_chunks(self, f: BinaryIO) -> Iterator[memoryview]:
+        """Iterate over file content by slices of memory map without copying, sent pages are dropped from page cache.
+        Files which could not be mapped (writable, empty, special) are read into one reused buffer"""
+        fd = f.fileno()
+        mapped = self._map_file(fd)
+        if mapped is None:
+            self._fadvise(fd, 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            buf = bytearray(self.PART)
+            with memoryview(buf) as view:
+                while True:
+                    count = f.readinto(buf)
+                    if not count:
+                        break
+                    chunk = view[:count]
+                    try:
+                        yield chunk
+                    finally:
+                        chunk.release()
+            return
+        with mapped, memoryview(mapped) as view:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            dropped = 0
+            for offset in range(0, len(mapped), self.PART):
+                chunk = view[offset:offset + self.PART]
+                try:
+                    yield chunk
+                finally:
+                    chunk.release()  # map could not be closed while slices exist
+                if offset - dropped >= self.CACHE_DROP_WINDOW:
+                    self._fadvise(fd, dropped, offset - dropped, 'POSIX_FADV_DONTNEED')
+                    dropped = offset
+
+
+    @staticmethod
+    def _put(chunks: Queue, item, stop: Event) -> bool:
+        """Put item to queue, give up if consumer stopped"""
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=.5)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _read_ahead(self, paths: Iterable[Optional[str]], chunks: Queue, stop: Event):
+        """Read files one by one into queue: (path, size or error) header, chunks, empty chunk as end mark
+        or read error instead of it. None is put at the end always, even if reading failed unexpectedly"""
+        try:
+            for path in paths:
+                try:
+                    if path is None or not os.path.isfile(path):
+                        raise FileNotFoundError('No such file')
+                    f = open(path, 'rb')
+                except OSError as e:
+                    if not self._put(chunks, (path, e), stop):
+                        return
+                    continue
+                with f:
+                    self._fadvise(f.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+                    if not self._put(chunks, (path, os.fstat(f.fileno()).st_size), stop):
+                        return
+                    while True:
+                        try:
+                            chunk = f.read(self.PART)
+                        except OSError as e:
+                            self.log(f'Read error "{path}": {e}', WARNING)
+                            if not self._put(chunks, e, stop):
+                                return
+                            break
+                        if not self._put(chunks, chunk, stop):
+                            return
+                        if len(chunk) == 0:
+                            break
+        except Exception as e:
+            self.log(f'Read of files batch failed: {e}', ERROR)
+        finally:
+            self._put(chunks, None, stop)
+
+    def send_files_batch(self, request: RPCRequest, names: List[str], paths: List[Optional[str]]):
+        """Send several files back to back in one response, next files are read while current one is sending.
+        Every file is preceded by "file" notification with name and size and followed by empty message.
+        If file read fails in the middle, empty message is followed by "file_error" notification,
+        data of this file received by client is incomplete. If reading stopped unexpectedly, rest of files
+        is not sent"""
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK', count=len(names))))
+        chunks, stop = Queue(self.READ_AHEAD), Event()
+        reader = Thread(target=self._read_ahead, args=(paths, chunks, stop), name='Thread-Read-Ahead', daemon=True)
+        reader.start()
+        sent = index = 0
+        try:
+            while True:
+                header = chunks.get()
+                if header is None:
+                    break
+                _, size = header
+                if isinstance(size, Exception):
+                    self.rpc_send(RPCRequest('file', dict(index=index, name=names[index], code=2, message=str(size))))
+                    index += 1
+                    continue
+                self.rpc_send(RPCRequest('file', dict(index=index, name=names[index], code=0, size=size)))
+                while True:
+                    chunk = chunks.get()
+                    if chunk is None or isinstance(chunk, Exception):
+                        message = 'Read stopped' if chunk is None else f'Read error: {chunk}'
+                        self.send(b'')
+                        self.rpc_send(RPCRequest('file_error', dict(index=index, name=names[index], code=2,
+                                                                    message=message)))
+                        break
+                    self.send(chunk)
+                    if len(chunk) == 0:
+                        sent += 1
+                        break
+                if chunk is None:
+                    break
+                index += 1
+        finally:
+            stop.set()
+        self.log(f'Files batch sent ({sent} of {len(names)} files)')
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK', sent=sent)))
@@ -1,10 +1,108 @@
+import time
+import hashlib
 import subprocess
-from typing import List
+from threading import Thread, Lock
+from types import MappingProxyType
+from typing import List, Tuple
 
-from .base import Plugin, HandlerExit, HandlerFail
+from .base import Plugin, PluginContext, HandlerExit, HandlerFail
 from ..common import *
 
 
+class ClipboardState:
+    """Cached content of one system clipboard, refreshed by watcher process or rate-limited polling"""
+    TIMEOUT = 15
+    WATCH_RETRY = 60  # seconds of polling before restart of stopped watcher command
+
+    def __init__(self, log: Callable, read_cmd: str, watch_cmd: Optional[str], poll_interval: int):
+        self.log, self.read_cmd, self.watch_cmd, self.poll_interval = log, read_cmd, watch_cmd, poll_interval / 1000
+        self.lock = Lock()
+        self.text: Optional[str] = None
+        self.hash = ''
+        self.last_read = 0.0
+        self.stale = True
+        self.watcher: Optional[Thread] = None
+        self.watch_retry_at = 0.0
+
+    def set(self, text: str):
+        """Update cached content"""
+        self.text, self.hash = text, hashlib.sha256(text.encode(errors='ignore')).hexdigest()[:32]
+        self.last_read, self.stale = time.monotonic(), False
+
+    def watch(self):
+        """Read output of watcher command, each line means clipboard change"""
+        try:
+            process = subprocess.Popen(self.watch_cmd, shell=True, stdout=subprocess.PIPE)
+            for _ in process.stdout:
+                self.stale = True
+            process.wait()
+        except Exception as e:
+            self.log(f'Clipboard watcher "{self.watch_cmd}" failed: {e}')
+        self.log(f'Clipboard watcher "{self.watch_cmd}" stopped, polling used for {self.WATCH_RETRY} s')
+        with self.lock:
+            self.stale, self.watcher = True, None
+            self.watch_retry_at = time.monotonic() + self.WATCH_RETRY
+
+    def read(self) -> Tuple[str, str]:
+        """Get clipboard content and its hash, run read command only if content may be changed"""
+        with self.lock:
+            if self.watch_cmd and self.watcher is None and time.monotonic() >= self.watch_retry_at:
+                self.watcher = Thread(target=self.watch, name='Thread-Clipboard-Watcher', daemon=True)
+                self.watcher.start()
+            expired = self.watcher is None and time.monotonic() - self.last_read >= self.poll_interval
+            if self.text is None or self.stale or expired:
+                self.set(subprocess.check_output(self.read_cmd, timeout=self.TIMEOUT, shell=True)
+                         .decode(errors='ignore'))
+            return self.text, self.hash
+
+    def write(self, write_cmd: str, text: str):
+        """Write text to clipboard and update cache"""
+        with self.lock:
+            subprocess.run(write_cmd, shell=True, timeout=self.TIMEOUT, input=text.encode(errors='ignore'))
+            self.set(text)
+
+
+class ClipboardService:
+    """Clipboard states shared by all plugins and connections"""
+    states: Dict[str, ClipboardState] = dict()
+    lock = Lock()
+
+    @classmethod
+    def get(cls, log: Callable, conf: Dict[str, Any], clipboard: str) -> ClipboardState:
+        """Get state of clipboard by its config entry"""
+        read_cmd = conf['read'].format(clipboard=clipboard)
+        with cls.lock:
+            state = cls.states.get(read_cmd)
+            if state is None:
+                watch_cmd = conf.get('watch')
+                state = cls.states[read_cmd] = ClipboardState(
+                    log, read_cmd, watch_cmd.format(clipboard=clipboard) if watch_cmd else None,
+                    conf.get('poll_interval') or 0)
+            return state
+
+    @classmethod
+    def read_response(cls, log: Callable, request: RPCRequest, conf: Dict[str, Any], clipboard: str) -> RPCResponse:
+        """Create response to clipboard read request, text omitted if client already has it"""
+        text, text_hash = cls.get(log, conf, clipboard).read()
+        if request.params.get('hash') == text_hash:
+            return RPCResponse(request.id, {'code': 0, 'not_modified': True, 'hash': text_hash})
+        return RPCResponse(request.id, {'code': 0, 'text': text, 'hash': text_hash})
+
+
+class ClipboardContext(PluginContext):
+    """Clipboard plugin config with clipboards indexed by stable keys"""
+
+    def __init__(self, conf: Dict[str, Any]):
+        super().__init__(conf)
+        clipboards_index, clipboards_list = dict(), list()
+        for entry in self.conf.get(ClipboardPlugin.CLIPBOARDS_LIST_KEY, ()):
+            key = hashlib.sha1(f'{entry["name"]}\0{entry["clipboard"]}'.encode()).hexdigest()[:16]
+            clipboards_index[key] = entry
+            clipboards_list.append({'key': key, 'name': entry['name'], 'readable': bool(entry['read']),
+                                    'writeable': bool(entry['write'])})
+        self.clipboards_index, self.clipboards_list = MappingProxyType(clipboards_index), tuple(clipboards_list)
+
+
 class ClipboardPlugin(Plugin):
     """Send/receive clipboard content to/from phone"""
     MARK = b'clip'
@@ -21,51 +119,46 @@ class ClipboardPlugin(Plugin):
         TemplateEntry('write', 'Template of clipboard write command', False, 0, 0xFFFF, None,  replacements=(
             Rep('clipboard', 'System name of using clipboard', True),
         )),
+        TemplateEntry('watch', 'Template of long-running command printing line on every clipboard change',
+                      True, 0, 0xFFFF, None, replacements=(Rep('clipboard', 'System name of using clipboard', True),)),
+        IntEntry('poll_interval', 'Time in milliseconds to use cached content if no watch command',
+                 True, 0, 3600000, 500),
     ))
     CLIPBOARD_CONFIG_DEFAULT = (dict(name='Clipboard',
                                      clipboard='clipboard',
                                      read='xclip -selection "{clipboard}" -o',
                                      write='xclip -selection "{clipboard}" -i'),)
     CLIPBOARDS_LIST_KEY = 'clipboards'
+    CONTEXT_CLASS = ClipboardContext
     CONFIG_SCHEMA = DictEntry('clip.conf.json', 'Common configuration for clipboard plugin', False, entries=(
         ListEntry(CLIPBOARDS_LIST_KEY, 'List of clipboards available for sync', False, 0, 0xFFFF,
                   CLIPBOARD_CONFIG_DEFAULT, entry=CLIPBOARD_CONFIG_SCHEMA),
     ))
 
-    def __init__(self, app, handler, device):
-        super().__init__(app, handler, device)
-        self.clipboards_index: Dict[str, Dict[str, str]] = dict()
-        self.clipboards_list: List[Dict[str, str]] = []
-        for clipboard_conf_entry in self.conf(self.CLIPBOARDS_LIST_KEY):
-            key = str(id(clipboard_conf_entry))
-            self.clipboards_index[key] = clipboard_conf_entry
-            self.clipboards_list.append({'key': key, 'name': clipboard_conf_entry['name'],
-                                         'readable': bool(clipboard_conf_entry['read']),
-                                         'writeable': bool(clipboard_conf_entry['write'])})
-
     def handle_list(self, request: RPCRequest):
         """Return list of clipboards to client"""
-        return self.rpc_send(RPCResponse(request.id, self.clipboards_list))
+        return self.rpc_send(RPCResponse(request.id, self.context.clipboards_list))
 
-    def _get_clipboard_command(self, request: RPCRequest, command_name: str) -> str:
-        """Get and format some clipboard action command from index"""
+    def _get_clipboard_entry(self, request: RPCRequest) -> Dict[str, str]:
+        """Get clipboard config entry from index"""
         key: str = str(request.params['clipboard'])
-        if key not in self.clipboards_index:
+        if key not in self.context.clipboards_index:
             raise HandlerExit.new(request, 1, 'No such clipboard')
-        clipboard_entry = self.clipboards_index[key]
-        return clipboard_entry[command_name].format(clipboard=clipboard_entry['clipboard'])
+        return self.context.clipboards_index[key]
 
     def handle_read(self, request: RPCRequest):
         """Read text content from clipboard and send back to client"""
-        cmd = self._get_clipboard_command(request, 'read')
-        text = subprocess.check_output(cmd, timeout=15, shell=True).decode(errors='ignore')
-        return self.rpc_send(RPCResponse(request.id, {'code': 0, 'text': text}))
+        clipboard_entry = self._get_clipboard_entry(request)
+        return self.rpc_send(ClipboardService.read_response(self.log, request, clipboard_entry,
+                                                            clipboard_entry['clipboard']))
 
     def handle_write(self, request: RPCRequest):
         """Write text content from client to clipboard"""
-        cmd = self._get_clipboard_command(request, 'write')
+        clipboard_entry = self._get_clipboard_entry(request)
+        clipboard = clipboard_entry['clipboard']
         try:
-            subprocess.run(cmd, shell=True, timeout=15, input=request.params['text'].encode(errors='ignore'))
+            ClipboardService.get(self.log, clipboard_entry, clipboard).write(
+                clipboard_entry['write'].format(clipboard=clipboard), request.params['text'])
         except Exception as e:
             return self.rpc_send(RPCResponse(request.id, {'code': 2, 'message': f'Error: {e}'}))
         return self.rpc_send(RPCResponse(request.id, {'code': 0, 'message': 'OK'}))
@@ -1,10 +1,22 @@
+import base64
 import fnmatch
+import hashlib
 import logging
-import subprocess
-from typing import List
+import itertools
+from threading import Lock
+from typing import List, Tuple
 
 from .base import BaseFilePlugin, HandlerExit, HandlerFail
 from ..common import *
+from ..common.shared_tree import SharedTreeCache, SearchIndex
+from ..common.thumbnails import ThumbnailCache, thumbnails_supported
+
+
+class SharedSnapshot:
+    """Immutable result of shared directories listing: tree sent to client and index of files with sizes"""
+
+    def __init__(self, snapshot_id: str, tree: List[Dict[str, Any]], files: Tuple[Tuple[str, int], ...]):
+        self.id, self.tree, self.files = snapshot_id, tree, files
 
 
 class FileTransferPlugin(BaseFilePlugin):
@@ -35,106 +47,276 @@ class FileTransferPlugin(BaseFilePlugin):
                                   False, 0, 1073741824, '*'),
                       IntEntry('deep', 'Recursion deep for subdirectories', False, 1, 1024, 1)
                   ))),
+        DirEntry('thumbnail_directory', 'Directory to cache thumbnails of shared images',
+                 True, '$DCNNT_RUNTIME_DIR/thumbnails', True, False),
+        IntEntry('thumbnail_cache_size', 'Max size of thumbnails cache in MiB', True, 1, 1048576, 64),
+        IntEntry('thumbnail_workers', 'Count of threads generating thumbnails', True, 1, 64, 2),
     ))
-    shared_files_index = list()
+    SNAPSHOTS_KEPT = 4
+    THUMBNAIL_SIZE_MIN, THUMBNAIL_SIZE_MAX = 16, 1024  # limits of thumbnail side in pixels
+    LIST_DIR_PAGE = 256  # max count of entries in one page of directory listing
+    tree_cache = SharedTreeCache()
+    search_index = SearchIndex(tree_cache)
+    snapshots: Dict[int, Dict[str, SharedSnapshot]] = dict()
+    snapshots_lock = Lock()
+    snapshots_counter = itertools.count(1)
+    thumbnail_caches: Dict[str, ThumbnailCache] = dict()
+    thumbnail_caches_lock = Lock()
+
+    def __init__(self, app, handler, device):
+        super().__init__(app, handler, device)
+        self.snapshot: Optional[SharedSnapshot] = None
 
     @staticmethod
     def check_file_filter(path: str, glob_str: str) -> bool:
         """Check if file allowed for sharing by filter"""
         return fnmatch.fnmatch(path, glob_str)
 
-    def shared_directory_list(self, directory: str, filter_data, max_deep, current_deep):
+    def shared_directory_list(self, directory: str, filter_data, max_deep, current_deep,
+                              files: List[Tuple[str, int]]):
         """Create information node for one shared directory"""
         res = list()
         try:
-            dir_list = os.listdir(directory)
-        except (PermissionError, OSError) as e:
+            listing = self.tree_cache.listdir(directory)
+        except OSError as e:
             self.log(f'Could not list content of directory "{directory}" ({e})')
             return res
-        for name in dir_list:
+        for name, is_dir, size, _ in listing:
             path = os.path.join(directory, name)
-            if os.path.isdir(path):
+            if is_dir:
                 if current_deep < max_deep and max_deep > 0:
-                    dir_list = self.shared_directory_list(path, filter_data, max_deep, current_deep + 1)
+                    dir_list = self.shared_directory_list(path, filter_data, max_deep, current_deep + 1, files)
                     res.append(dict(name=name, node_type='directory', size=len(dir_list), children=dir_list))
-            elif os.path.isfile(path):
-                if self.check_file_filter(path, filter_data):
-                    self.shared_files_index.append(path)
-                    index = len(self.shared_files_index) - 1
-                    res.append(dict(name=name, node_type='file', size=os.path.getsize(path), index=index))
+            elif self.check_file_filter(path, filter_data):
+                res.append(dict(name=name, node_type='file', size=size, index=len(files)))
+                files.append((path, size))
         return res
 
-    def process_shared_directory(self, path: str, name: Optional[str], glob: str, deep: int,
-                                 res: List[Dict[str, Any]], names: Dict[str, int]):
-        """Process one shared directory record"""
-        if not os.path.isdir(path):
-            self.log(f'Shared directory "{path}" not found', logging.WARN)
-            return
-        if name is None:
-            name = os.path.basename(path)
-        if name in names:
-            names[name] += 1
-            name += f' ({names[name]})'
-        else:
-            names[name] = 0
-        dir_list = self.shared_directory_list(path, glob, deep, 1)
-        res.append(dict(name=name, node_type='directory', size=len(dir_list), children=dir_list))
-
-    def shared_files_info(self) -> list:
-        """Create tree structure of shared directories"""
-        self.shared_files_index.clear()
-        res = list()
-        names = dict()
-        for shared_dir in self.conf('shared_dirs'):
-            self.process_shared_directory(shared_dir['path'], shared_dir['name'], shared_dir['glob'],
-                                          shared_dir.get('deep', 0), res, names)
+    def shared_roots(self) -> List[Tuple[str, str, str, str, int]]:
+        """Get existing shared directories with unique visible names: key, name, path, glob and deep"""
+        entries = [(i['path'], i['name'], i['glob'], i.get('deep', 0)) for i in self.conf('shared_dirs')]
         for shared_dirs_import in self.conf('shared_dirs_external'):
             import_path, glob = shared_dirs_import['path'], shared_dirs_import['glob']
             deep = shared_dirs_import.get('deep', 0)
-            if not os.path.isfile(import_path):
+            try:
+                lines = self.tree_cache.read_list(import_path)
+            except OSError:
                 self.log(f'List of shared directories "{import_path}" not found', logging.INFO)
                 continue
-            with open(import_path) as f:
-                for path in f.read().splitlines(keepends=False):
-                    path = Template(path).safe_substitute(self.app.environment)
-                    self.process_shared_directory(path, None, glob, deep, res, names)
+            entries.extend((Template(path).safe_substitute(self.app.environment), None, glob, deep) for path in lines)
+        res, names = list(), dict()
+        for path, name, glob, deep in entries:
+            if not os.path.isdir(path):
+                self.log(f'Shared directory "{path}" not found', logging.WARN)
+                continue
+            if name is None:
+                name = os.path.basename(path)
+            if name in names:
+                names[name] += 1
+                name += f' ({names[name]})'
+            else:
+                names[name] = 0
+            key = hashlib.sha1(f'{path}\0{glob}\0{deep}'.encode()).hexdigest()[:12]
+            res.append((key, name, path, glob, deep))
         return res
 
+    def shared_files_info(self) -> SharedSnapshot:
+        """Create tree structure of shared directories and save it as snapshot of current session"""
+        res, files = list(), list()
+        for _, name, path, glob, deep in self.shared_roots():
+            dir_list = self.shared_directory_list(path, glob, deep, 1, files)
+            res.append(dict(name=name, node_type='directory', size=len(dir_list), children=dir_list))
+        snapshot = SharedSnapshot(str(next(self.snapshots_counter)), res, tuple(files))
+        with self.snapshots_lock:
+            snapshots = self.snapshots.setdefault(self.device.uin, dict())
+            snapshots[snapshot.id] = snapshot
+            for snapshot_id in tuple(snapshots)[:-self.SNAPSHOTS_KEPT]:
+                del snapshots[snapshot_id]
+        self.snapshot = snapshot
+        return snapshot
+
+    def get_snapshot(self, snapshot_id: Optional[str]) -> SharedSnapshot:
+        """Get snapshot by ID or the last one of session or device, create new snapshot if not found"""
+        with self.snapshots_lock:
+            snapshots = self.snapshots.get(self.device.uin, dict())
+            if snapshot_id is not None:
+                snapshot = snapshots.get(str(snapshot_id))
+            elif self.snapshot is not None:
+                snapshot = self.snapshot
+            else:
+                snapshot = snapshots[next(reversed(tuple(snapshots)))] if snapshots else None
+        if snapshot is None:
+            self.log(f'Snapshot {snapshot_id} not found, create new one')
+            snapshot = self.shared_files_info()
+        return snapshot
+
+    @staticmethod
+    def make_handle(key: str, parts: Tuple[str, ...]) -> str:
+        """Create opaque handle of shared directory or file"""
+        return base64.urlsafe_b64encode('/'.join((key, ) + parts).encode()).decode().rstrip('=')
+
+    def resolve_handle(self, request: RPCRequest, handle: Any) -> Tuple[Tuple[str, str, str, str, int],
+                                                                          Tuple[str, ...], str]:
+        """Get shared directory, relative path parts and full path for handle, escaping paths are rejected"""
+        try:
+            key, _, relpath = base64.urlsafe_b64decode(handle + '=' * (-len(handle) % 4)).decode().partition('/')
+        except (TypeError, ValueError):
+            raise HandlerExit.new(request, 1, 'Incorrect handle')
+        parts = tuple(relpath.split('/')) if relpath else ()
+        if any(i in {'', '.', '..'} or '\0' in i for i in parts):
+            raise HandlerExit.new(request, 1, 'Incorrect handle')
+        for root in self.shared_roots():
+            if root[0] == key:
+                return root, parts, os.path.join(root[2], *parts)
+        raise HandlerExit.new(request, 1, 'No such shared directory')
+
+    def handle_list_dir(self, request: RPCRequest):
+        """Return one page of content of one shared directory, list of shared directories if no handle"""
+        handle = request.params.get('handle')
+        offset, limit = request.params.get('offset', 0), request.params.get('limit', self.LIST_DIR_PAGE)
+        if not isinstance(offset, int) or not isinstance(limit, int) or offset < 0 or limit < 1:
+            raise HandlerExit.new(request, 2, 'Incorrect offset or limit')
+        limit = min(limit, self.LIST_DIR_PAGE)
+        if handle is None:
+            name, entries = None, self.shared_roots()
+            page = [dict(name=root_name, node_type='directory', handle=self.make_handle(key, ()))
+                    for key, root_name, *_ in entries[offset:offset + limit]]
+        else:
+            (key, name, _, glob, deep), parts, path = self.resolve_handle(request, handle)
+            if len(parts) >= deep:
+                raise HandlerExit.new(request, 1, 'No such directory')
+            try:
+                listing = self.tree_cache.listdir(path)
+            except OSError as e:
+                self.log(f'Could not list content of directory "{path}" ({e})')
+                raise HandlerExit.new(request, 1, 'No such directory')
+            name = parts[-1] if parts else name
+            entries = [i for i in listing if (len(parts) + 1 < deep if i[1] else
+                                              self.check_file_filter(os.path.join(path, i[0]), glob))]
+            page = list()
+            for entry_name, is_dir, size, mtime in entries[offset:offset + limit]:
+                entry_handle = self.make_handle(key, parts + (entry_name, ))
+                if is_dir:
+                    page.append(dict(name=entry_name, node_type='directory', handle=entry_handle))
+                else:
+                    page.append(dict(name=entry_name, node_type='file', size=size, mtime=mtime // 1000000,
+                                     handle=entry_handle))
+        next_offset = offset + limit if offset + limit < len(entries) else None
+        self.rpc_send(RPCResponse(request.id, dict(code=0, name=name, total=len(entries), offset=offset,
+                                                   next_offset=next_offset, entries=page)))
+
+    def handle_search(self, request: RPCRequest):
+        """Find shared files by words in path, return one page of ranked results"""
+        query = request.params.get('query')
+        offset, limit = request.params.get('offset', 0), request.params.get('limit', self.LIST_DIR_PAGE)
+        if not isinstance(query, str):
+            raise HandlerExit.new(request, 2, 'Incorrect query')
+        if not isinstance(offset, int) or not isinstance(limit, int) or offset < 0 or limit < 1:
+            raise HandlerExit.new(request, 2, 'Incorrect offset or limit')
+        limit = min(limit, self.LIST_DIR_PAGE)
+        roots = self.shared_roots()
+        names = {key: name for key, name, *_ in roots}
+        with self.search_index.lock:
+            for key, _, path, glob, deep in roots:
+                self.search_index.update(key, path, glob, deep)
+            found = self.search_index.search(names, query)
+        entries = [dict(name=parts[-1], path='/'.join((names[key], ) + parts), node_type='file', size=size,
+                        mtime=mtime // 1000000, handle=self.make_handle(key, parts))
+                   for key, parts, _, size, mtime in found[offset:offset + limit]]
+        next_offset = offset + limit if offset + limit < len(found) else None
+        self.rpc_send(RPCResponse(request.id, dict(code=0, total=len(found), offset=offset, next_offset=next_offset,
+                                                   entries=entries)))
+
+    def resolve_file_handle(self, request: RPCRequest, handle: Any) -> str:
+        """Get path of shared file by handle, check if file visible for device"""
+        (_, _, _, glob, deep), parts, path = self.resolve_handle(request, handle)
+        if not parts or len(parts) > deep or not self.check_file_filter(path, glob) or not os.path.isfile(path):
+            raise HandlerExit.new(request, 1, 'No such file')
+        return path
+
     def handle_upload(self, request: RPCRequest):
         """Receive and save file from client"""
         path = self.receive_file(request, self.conf('download_directory'))
         on_download = self.conf('on_download')
         if isinstance(on_download, str):
-            command = on_download.format(path=path)
-            self.log('Execute: "{}"'.format(command))
-            subprocess.call(command, shell=True)
+            self.app.hooks.submit(on_download, on_download.format(path=path), path)
 
     def handle_list_shared(self, request: RPCRequest):
         """Create shared files info and return as JSON"""
         try:
-            result = self.shared_files_info()
+            snapshot = self.shared_files_info()
         except Exception as e:
             self.logger.exception('[FileTransferPlugin] {}'.format(e))
             result = INTERNAL_ERROR
+        else:
+            result = dict(snapshot=snapshot.id, tree=snapshot.tree) if request.params.get('snapshot') \
+                else snapshot.tree
         self.rpc_send(RPCResponse(request.id, result))
 
     def handle_download(self, request):
         """Handle try of device to download file from server"""
+        if request.params.get('handle') is not None:
+            return self.send_file(request, self.resolve_file_handle(request, request.params['handle']),
+                                  request.params.get('size'))
         try:
             index, size = request.params['index'], request.params['size']
         except KeyError as e:
             self.log('KeyError {}'.format(e), logging.WARN)
         else:
             self.log('Download request is correct')
-            if 0 <= index < len(self.shared_files_index):
-                path = self.shared_files_index[index]
-                self.send_file(request, path, size)
+            snapshot = self.get_snapshot(request.params.get('snapshot'))
+            if isinstance(index, int) and 0 <= index < len(snapshot.files):
+                path, _ = snapshot.files[index]
+                try:
+                    self.send_file(request, path, size)
+                except HandlerExit:
+                    self.tree_cache.invalidate(os.path.dirname(path))
+                    raise
             else:
                 self.rpc_send(RPCResponse(request.id, dict(code=1, message='No such index: {}'.format(index))))
 
+    def thumbnail_cache(self) -> ThumbnailCache:
+        """Get thumbnails cache for configured directory"""
+        directory = self.conf('thumbnail_directory')
+        with self.thumbnail_caches_lock:
+            cache = self.thumbnail_caches.get(directory)
+            if cache is None:
+                cache = self.thumbnail_caches[directory] = ThumbnailCache(
+                    directory, self.conf('thumbnail_cache_size') * 1048576, self.conf('thumbnail_workers'))
+        return cache
+
+    def handle_thumbnail(self, request: RPCRequest):
+        """Send downscaled JPEG copy of shared image selected by handle or index in snapshot"""
+        if not thumbnails_supported():
+            raise HandlerExit.new(request, 3, 'Thumbnails not supported')
+        max_size = request.params.get('max_size', 256)
+        if not isinstance(max_size, int):
+            raise HandlerExit.new(request, 2, 'Incorrect max_size')
+        max_size = min(max(max_size, self.THUMBNAIL_SIZE_MIN), self.THUMBNAIL_SIZE_MAX)
+        if request.params.get('handle') is not None:
+            path = self.resolve_file_handle(request, request.params['handle'])
+        else:
+            index = request.params.get('index')
+            snapshot = self.get_snapshot(request.params.get('snapshot'))
+            if not isinstance(index, int) or not 0 <= index < len(snapshot.files):
+                raise HandlerExit.new(request, 1, 'No such index: {}'.format(index))
+            path, _ = snapshot.files[index]
+        try:
+            thumbnail = self.thumbnail_cache().get(path, max_size)
+        except Exception as e:
+            self.log(f'Could not create thumbnail of "{path}": {e}', logging.WARN)
+            raise HandlerExit.new(request, 2, 'Could not create thumbnail')
+        self.send_file(request, thumbnail)
+
     def process_request(self, request: RPCRequest):
         if request.method == 'list':
             self.handle_list_shared(request)
+        elif request.method == 'list_dir':
+            self.handle_list_dir(request)
+        elif request.method == 'search':
+            self.handle_search(request)
+        elif request.method == 'thumbnail':
+            self.handle_thumbnail(request)
         elif request.method == 'download':
             self.handle_download(request)
         elif request.method == 'upload':
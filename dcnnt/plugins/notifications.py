@@ -1,11 +1,99 @@
+import re
+import time
 import logging
+import hashlib
 import subprocess
 from shlex import quote
+from collections import deque
+from threading import Thread, Lock, Condition
+from typing import Deque, Tuple, List
 
 from .base import Plugin
 from ..common import *
 
 
+class NotificationQueue:
+    """Show notifications one by one in persistent worker, coalesce bursts of one package and drop duplicates"""
+    MAX_COALESCED_TEXTS = 5
+
+    def __init__(self, name: str, quote: Callable[[Any], str]):
+        self.log, self.quote = logging.getLogger('dcnnt'), quote
+        self.prefix = f'[{name}]'
+        self.cond = Condition()
+        self.ready: Deque[Dict[str, Any]] = deque()
+        # Bursts of notifications: (uin, package) -> [deadline, window, notifications]
+        self.bursts: Dict[Tuple[int, str], list] = dict()
+        self.recent: Dict[Tuple[int, str, str, str], float] = dict()
+
+    def is_duplicate(self, notification: Dict[str, Any], dedupe_window: float, now: float) -> bool:
+        """Check if same notification already shown recently"""
+        key = tuple(map(notification.get, ('uin', 'package', 'title', 'text')))
+        last = self.recent.get(key)
+        self.recent[key] = now
+        if len(self.recent) > 4096:
+            for i in tuple(k for k, ts in self.recent.items() if now - ts > 3600):
+                del self.recent[i]
+        return last is not None and now - last < dedupe_window
+
+    def put(self, notification: Dict[str, Any], coalesce_window: int, dedupe_window: int):
+        """Add notification to queue: first notification of burst shown immediately, others collected to one"""
+        now = time.monotonic()
+        with self.cond:
+            if self.is_duplicate(notification, (dedupe_window or 0) / 1000, now):
+                self.log.debug(f'{self.prefix} Duplicate notification dropped')
+                return
+            key = notification['uin'], notification['package']
+            burst = self.bursts.get(key)
+            if burst is not None:
+                burst[2].append(notification)
+            else:
+                if coalesce_window:
+                    self.bursts[key] = [now + coalesce_window / 1000, coalesce_window / 1000, []]
+                self.ready.append(notification)
+            self.cond.notify()
+
+    def coalesce(self, notifications: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Create one notification from several ones"""
+        res = dict(notifications[-1])
+        if len(notifications) > 1:
+            res['title'] = f'{res["title"]} ({len(notifications)} new)'
+            res['text'] = '\n'.join(i['text'] for i in notifications[-self.MAX_COALESCED_TEXTS:])
+        return res
+
+    def take_expired(self, now: float) -> float:
+        """Move collected bursts to ready queue, return time to wait for next deadline"""
+        timeout = 60.0
+        for key, burst in tuple(self.bursts.items()):
+            deadline, window, notifications = burst
+            if deadline <= now:
+                if notifications:
+                    self.ready.append(self.coalesce(notifications))
+                    burst[0], burst[2] = now + window, []
+                else:
+                    del self.bursts[key]
+                    continue
+            timeout = min(timeout, burst[0] - now)
+        return timeout
+
+    def worker(self):
+        """Show notifications from queue"""
+        while True:
+            with self.cond:
+                while True:
+                    timeout = self.take_expired(time.monotonic())
+                    if self.ready:
+                        notification = self.ready.popleft()
+                        break
+                    self.cond.wait(timeout)
+            quote = self.quote
+            command = notification['cmd'].format(**{k: quote(v) for k, v in notification.items() if k != 'cmd'})
+            self.log.info(f'{self.prefix} Execute: "{command}"')
+            try:
+                subprocess.call(command, shell=True)
+            except Exception as e:
+                self.log.exception(e)
+
+
 class NotificationsPlugin(Plugin):
     """Receive notifications from phone"""
     MARK = b'nots'
@@ -23,9 +111,18 @@ class NotificationsPlugin(Plugin):
                           Rep('icon', 'Path to saved notification icon', True),
                           Rep('title', 'Title of notification', True),
                           Rep('text', 'Main content of notification', True),
-                      ))
+                      )),
+        IntEntry('coalesce_window', 'Time in milliseconds to collect notifications of one package into one, '
+                                    '0 - show every notification', True, 0, 3600000, 0),
+        IntEntry('dedupe_window', 'Time in milliseconds to drop repeated identical notifications',
+                 True, 0, 3600000, 1000),
     ))
 
+    ICON_HASH_RE = re.compile('[0-9a-f]{64}')
+    known_icons = set()  # paths of cached icons, icon_dir may differ for devices
+    notification_queue = None
+    queue_lock = Lock()
+
     def __init__(self, app, handler, device):
         super().__init__(app, handler, device)
 
@@ -34,6 +131,50 @@ class NotificationsPlugin(Plugin):
         """Quote arg for notification command"""
         return quote(f'{a}').strip("'")
 
+    @classmethod
+    def queue(cls) -> 'NotificationQueue':
+        """Get common queue of notifications, start display worker on first use"""
+        with cls.queue_lock:
+            if cls.notification_queue is None:
+                cls.notification_queue = NotificationQueue(cls.NAME, cls.quote)
+                Thread(target=cls.notification_queue.worker, name='Thread-Notifications', daemon=True).start()
+            return cls.notification_queue
+
+    def icon_path(self, icon_hash: str) -> str:
+        """Path to cached icon by hash of its content"""
+        return os.path.join(self.conf('icon_dir'), 'icons', f'{icon_hash}.png')
+
+    def icon_known(self, icon_hash: Any) -> bool:
+        """Check if icon with such hash already cached"""
+        if not isinstance(icon_hash, str) or not self.ICON_HASH_RE.fullmatch(icon_hash):
+            return False
+        icon_path = self.icon_path(icon_hash)
+        if icon_path in self.known_icons:
+            return True
+        if os.path.isfile(icon_path):
+            self.known_icons.add(icon_path)
+            return True
+        return False
+
+    def save_icon(self, icon_data: bytes) -> str:
+        """Save icon to cache if there is no such one yet, return path to cached icon"""
+        icon_hash = hashlib.sha256(icon_data).hexdigest()
+        icon_path = self.icon_path(icon_hash)
+        if not self.icon_known(icon_hash):
+            os.makedirs(os.path.dirname(icon_path), exist_ok=True)
+            tmp_path = f'{icon_path}.{id(icon_data)}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(icon_data)
+            os.replace(tmp_path, icon_path)
+            self.known_icons.add(icon_path)
+        return icon_path
+
+    def handle_icons(self, request: RPCRequest):
+        """Tell client which of icons are already cached, so they should not be sent"""
+        hashes = request.params.get('hashes')
+        if isinstance(hashes, list) and request.id is not None:
+            self.rpc_send(RPCResponse(request.id, dict(known=[i for i in hashes if self.icon_known(i)])))
+
     def main(self):
         while True:
             request = self.rpc_read()
@@ -44,7 +185,9 @@ class NotificationsPlugin(Plugin):
             cmd = self.conf('cmd')
             if not cmd:
                 return
-            if request.method == 'notification':
+            if request.method == 'icons':
+                self.handle_icons(request)
+            elif request.method == 'notification':
                 icon_data = self.read() if request.params.get('packageIcon', False) else None
                 if request.params.get('event') == 'posted':
                     text, package = map(request.params.get, ('text', 'package'))
@@ -52,14 +195,13 @@ class NotificationsPlugin(Plugin):
                     name, uin = self.device.name, self.device.uin
                     if text is None:
                         text = ''
-                    icon_path = os.path.join(self.conf('icon_dir'), f'{package}.{self.device.uin}.icon.png')
+                    icon = ''
                     if bool(icon_data):
                         try:
-                            open(icon_path, 'wb').write(icon_data)
+                            icon = self.save_icon(icon_data)
                         except Exception as e:
                             self.log(e, logging.WARNING)
-                    icon = icon_path if icon_data else ''
-                    command = cmd.format(uin=self.quote(uin), name=self.quote(name), icon=self.quote(icon),
-                                         text=self.quote(text), title=self.quote(title), package=self.quote(package))
-                    self.log('Execute: "{}"'.format(command))
-                    subprocess.call(command, shell=True)
+                    elif self.icon_known(request.params.get('packageIconHash')):
+                        icon = self.icon_path(request.params['packageIconHash'])
+                    self.queue().put(dict(cmd=cmd, uin=uin, name=name, package=package, icon=icon, title=title,
+                                          text=text), self.conf('coalesce_window'), self.conf('dedupe_window'))
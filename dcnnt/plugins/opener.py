@@ -1,5 +1,3 @@
-import subprocess
-
 from .base import BaseFilePlugin, PluginFail
 from ..common import *
 
@@ -29,9 +27,7 @@ class OpenerPlugin(BaseFilePlugin):
         """Receive and show file from client"""
         path = self.receive_file(request, self.conf(('file', 'download_directory')))
         on_download = self.conf(('file', 'default_cmd'))
-        command = on_download.format(path=path)
-        self.log('Execute: "{}"'.format(command))
-        subprocess.call(command, shell=True)
+        self.app.hooks.submit(on_download, on_download.format(path=path), path, False)
 
     def handle_open_link(self, request):
         """Open URL received from client"""
@@ -39,9 +35,8 @@ class OpenerPlugin(BaseFilePlugin):
         if not isinstance(url, str):
             raise PluginFail('No "link" param in request')
         self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK')))
-        command = self.conf(('link', 'default_cmd')).format(url=url)
-        self.log('Execute: "{}"'.format(command))
-        subprocess.call(command, shell=True)
+        cmd = self.conf(('link', 'default_cmd'))
+        self.app.hooks.submit(cmd, cmd.format(url=url), coalesce=False)
 
     def process_request(self, request: RPCRequest):
         if request.method == 'open_file':
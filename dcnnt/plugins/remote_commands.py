@@ -1,9 +1,123 @@
+import os
+import time
+import signal
+import hashlib
+import itertools
 import subprocess
+from threading import Thread, Lock, Condition
+from types import MappingProxyType
+from typing import Dict, Any, Tuple, Union, Optional
 
-from .base import Plugin
+from .base import Plugin, PluginContext
 from ..common import *
 
 
+class Job:
+    """Remote command running in background, output of command kept in memory"""
+    MAX_OUTPUT = 1048576  # bytes of every output stream kept
+    STREAMS = 'stdout', 'stderr'
+
+    def __init__(self, job_id: str, name: str, cmd: str, timeout: int):
+        self.id, self.name, self.cmd, self.timeout = job_id, name, cmd, timeout
+        self.status, self.exit_code, self.started, self.finished = 'running', None, time.time(), None
+        self.cond = Condition()
+        # Output streams: name -> [offset of first kept byte, kept bytes]
+        self.output = {i: [0, bytearray()] for i in self.STREAMS}
+        self.process = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, start_new_session=True)
+        self.readers = tuple(Thread(target=self.read_stream, args=(i, ), name=f'Thread-Job-{job_id}-{i}', daemon=True)
+                             for i in self.STREAMS)
+        for thread in self.readers:
+            thread.start()
+        Thread(target=self.wait, name=f'Thread-Job-{job_id}', daemon=True).start()
+
+    @property
+    def done(self) -> bool:
+        return self.status != 'running'
+
+    def read_stream(self, stream: str):
+        """Collect output of process"""
+        pipe = getattr(self.process, stream)
+        for chunk in iter(lambda: pipe.read1(65536), b''):
+            with self.cond:
+                start, buf = self.output[stream]
+                buf += chunk
+                if len(buf) > self.MAX_OUTPUT:
+                    excess = len(buf) - self.MAX_OUTPUT
+                    del buf[:excess]
+                    self.output[stream][0] = start + excess
+                self.cond.notify_all()
+
+    def wait(self):
+        """Wait for process end, kill it on timeout"""
+        try:
+            code = self.process.wait(self.timeout or None)
+        except subprocess.TimeoutExpired:
+            self.kill('timeout')
+            code = self.process.wait()
+        for thread in self.readers:
+            thread.join()
+        with self.cond:
+            self.exit_code, self.finished = code, time.time()
+            if self.status == 'running':
+                self.status = 'done' if code == 0 else 'failed'
+            self.cond.notify_all()
+
+    def kill(self, status: str):
+        """Kill process group of job"""
+        with self.cond:
+            if self.status != 'running':
+                return
+            self.status = status
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def read(self, stream: str, offset: int) -> Tuple[int, bytes]:
+        """Get output of stream from offset, return offset of returned data and data itself"""
+        with self.cond:
+            start, buf = self.output[stream]
+            offset = max(offset, start)
+            return offset, bytes(buf[offset - start:])
+
+    def info(self) -> Dict[str, Any]:
+        """Get job status as dictionary"""
+        return dict(job=self.id, name=self.name, status=self.status, exit_code=self.exit_code,
+                    started=self.started, finished=self.finished)
+
+
+def utf8_prefix(data: bytes, final: bool) -> Tuple[str, int]:
+    """Decode bytes leaving incomplete UTF-8 char at the end for next read, return text and count of used bytes"""
+    if not final:
+        for cut in range(min(3, len(data)) + 1):
+            try:
+                return data[:len(data) - cut].decode(), len(data) - cut
+            except UnicodeDecodeError as e:
+                if e.start < len(data) - 3:
+                    break
+    return data.decode(errors='replace'), len(data)
+
+
+class RemoteCommandsContext(PluginContext):
+    """Remote commands config with menu indexed by stable command IDs"""
+
+    def __init__(self, conf: Dict[str, Any]):
+        super().__init__(conf)
+        commands, index = dict(), list()
+        for command in self.conf.get('menu', ()):
+            name, description, cmd, method = map(command.get, ('name', 'description', 'cmd', 'method'))
+            if cmd is not None and method is not None:
+                identifier = hashlib.sha1(f'{name}\0{method}\0{cmd}'.encode()).hexdigest()[:16]
+                while identifier in commands:  # same entries in menu
+                    identifier = hashlib.sha1(identifier.encode()).hexdigest()[:16]
+                commands[identifier] = command
+            else:
+                identifier = None
+            index.append(dict(index=identifier, name=name, description=description))
+        self.commands, self.index = MappingProxyType(commands), tuple(index)
+
+
 class RemoteCommandsPlugin(Plugin):
     """Receive file from phone"""
     MARK = b'rcmd'
@@ -18,41 +132,106 @@ class RemoteCommandsPlugin(Plugin):
                       StringEntry('name', 'Displayed name for remote command', False, 0, 60, 'Do nothing'),
                       StringEntry('method', 'Method to execute command', True, 0, 1024, None),
                       StringEntry('cmd', 'Remote called command itself', True, 0, 1073741824, None),
-                  )))
+                      IntEntry('timeout', 'Command execution time limit in seconds, 0 - unlimited',
+                               True, 0, 31536000, None),
+                  ))),
+        IntEntry('max_jobs', 'Max count of commands running at once for one device', True, 1, 1024, 4),
+        IntEntry('timeout', 'Default command execution time limit in seconds, 0 - unlimited', True, 0, 31536000, 0),
     ))
+    CONTEXT_CLASS = RemoteCommandsContext
     PART = 65532
+    FINISHED_JOBS_KEPT = 16
+    jobs: Dict[int, Dict[str, Job]] = dict()
+    jobs_lock = Lock()
+    jobs_counter = itertools.count(1)
 
-    def __init__(self, app, handler, device):
-        super().__init__(app, handler, device)
-        self.remote_commands = dict()
-        self.remote_commands_index = list()
-        for command in self.conf('menu'):
-            name, description, cmd, method = map(command.get, ('name', 'description', 'cmd', 'method'))
-            if cmd is not None and method is not None:
-                identifier = str(hash(cmd + method))
-                self.remote_commands[identifier] = command
-            else:
-                identifier = None
-            self.remote_commands_index.append(dict(index=identifier, name=name, description=description))
+    @classmethod
+    def device_jobs(cls, uin: int) -> Dict[str, Job]:
+        """Get jobs of device, drop old finished ones"""
+        jobs = cls.jobs.setdefault(uin, dict())
+        finished = sorted((i for i in jobs.values() if i.done), key=lambda x: x.finished)
+        for job in finished[:-cls.FINISHED_JOBS_KEPT]:
+            del jobs[job.id]
+        return jobs
 
-    def handle_exec(self, request):
-        """Run command and send message with bool execution result"""
-        command = self.remote_commands.get(request.params.get('index', None))
+    def start_job(self, request: RPCRequest) -> Union[Job, str]:
+        """Start command as job, return job or error message"""
+        command = self.context.commands.get(request.params.get('index', None))
         if command is None:
-            self.rpc_send(RPCResponse(request.id, dict(result=False, message='No such command')))
+            return 'No such command'
+        method, cmd = command.get('method'), command.get('cmd')
+        if method != 'shell':
+            return 'No such method'
+        timeout = command.get('timeout')
+        with self.jobs_lock:
+            jobs = self.device_jobs(self.device.uin)
+            if sum(1 for i in jobs.values() if not i.done) >= self.conf('max_jobs'):
+                return 'Too many running commands'
+            self.log('Execute shell command: "{}"'.format(cmd))
+            job_id = f'{self.device.uin}.{next(self.jobs_counter)}'
+            job = jobs[job_id] = Job(job_id, command.get('name'), cmd,
+                                     self.conf('timeout') if timeout is None else timeout)
+        return job
+
+    def get_job(self, request: RPCRequest) -> Optional[Job]:
+        """Get job of device by ID from request params, send error response if not found"""
+        with self.jobs_lock:
+            job = self.device_jobs(self.device.uin).get(request.params.get('job'))
+        if job is None:
+            self.rpc_send(RPCResponse(request.id, dict(code=1, message='No such job')))
+        return job
+
+    def handle_exec(self, request):
+        """Run command, send job ID at once in async mode or bool execution result otherwise"""
+        try:
+            job = self.start_job(request)
+        except Exception as e:
+            self.logger.exception(e)
+            return self.rpc_send(RPCResponse(request.id, dict(result=False, message='Failed')))
+        if isinstance(job, str):
+            return self.rpc_send(RPCResponse(request.id, dict(result=False, message=job)))
+        if request.params.get('async'):
+            return self.rpc_send(RPCResponse(request.id, dict(result=True, message='OK', job=job.id)))
+        with job.cond:
+            job.cond.wait_for(lambda: job.exit_code is not None)
+        if job.status == 'done':
+            self.rpc_send(RPCResponse(request.id, dict(result=True, message='OK')))
         else:
-            method, cmd = command.get('method'), command.get('cmd')
-            if method == 'shell':
-                self.log('Execute shell command: "{}"'.format(cmd))
-                try:
-                    subprocess.check_call(cmd, shell=True)
-                except Exception as e:
-                    self.logger.exception(e)
-                    self.rpc_send(RPCResponse(request.id, dict(result=False, message='Failed')))
-                else:
-                    self.rpc_send(RPCResponse(request.id, dict(result=True, message='OK')))
-            else:
-                self.rpc_send(RPCResponse(request.id, dict(result=False, message='No such method')))
+            self.log(f'Command failed ({job.status}, exit code {job.exit_code}): "{job.cmd}"')
+            self.rpc_send(RPCResponse(request.id, dict(result=False, message='Failed')))
+
+    def handle_job_output(self, request: RPCRequest):
+        """Send output of job from offset, with "follow" param new output sent as notifications until job end"""
+        job = self.get_job(request)
+        if job is None:
+            return
+        stream, offset = request.params.get('stream', 'stdout'), request.params.get('offset', 0)
+        if stream not in Job.STREAMS or not isinstance(offset, int):
+            return self.rpc_send(RPCResponse(request.id, dict(code=2, message='Incorrect stream or offset')))
+        if request.params.get('follow'):
+            incomplete = 0  # bytes of incomplete UTF-8 char waiting for rest of it
+            while True:
+                with job.cond:
+                    job.cond.wait_for(lambda: job.exit_code is not None
+                                      or len(job.read(stream, offset)[1]) > incomplete, 60)
+                    done = job.exit_code is not None
+                    offset, data = job.read(stream, offset)
+                text, used = utf8_prefix(data, done)
+                incomplete = len(data) - used
+                if used:
+                    if not self.rpc_send(RPCRequest('job_output', dict(job=job.id, stream=stream, offset=offset,
+                                                                       data=text))):
+                        self.log(f'Output of job {job.id} is not followed anymore, sending failed')
+                        return
+                    offset += used
+                if done:
+                    break
+        with job.cond:
+            done = job.exit_code is not None
+            offset, data = job.read(stream, offset)
+        text, used = utf8_prefix(data, done)
+        self.rpc_send(RPCResponse(request.id, dict(code=0, **job.info(), stream=stream, offset=offset, data=text,
+                                                   next_offset=offset + used)))
 
     def main(self):
         while True:
@@ -62,6 +241,21 @@ class RemoteCommandsPlugin(Plugin):
                 self.log('No more requests, stop handler')
                 return
             if request.method == 'list':
-                self.rpc_send(RPCResponse(request.id, self.remote_commands_index))
+                self.rpc_send(RPCResponse(request.id, self.context.index))
             elif request.method == 'exec':
                 self.handle_exec(request)
+            elif request.method == 'jobs':
+                with self.jobs_lock:
+                    jobs = tuple(i.info() for i in self.device_jobs(self.device.uin).values())
+                self.rpc_send(RPCResponse(request.id, jobs))
+            elif request.method == 'job_status':
+                job = self.get_job(request)
+                if job is not None:
+                    self.rpc_send(RPCResponse(request.id, dict(code=0, **job.info())))
+            elif request.method == 'job_output':
+                self.handle_job_output(request)
+            elif request.method == 'job_cancel':
+                job = self.get_job(request)
+                if job is not None:
+                    job.kill('cancelled')
+                    self.rpc_send(RPCResponse(request.id, dict(code=0, **job.info())))
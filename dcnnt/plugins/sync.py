@@ -1,11 +1,356 @@
 import logging
 import shutil
 import time
+import hashlib
+import secrets
+import tempfile
 import subprocess
-from typing import List, Tuple
+from stat import S_ISDIR
+from collections import deque
+from types import MappingProxyType
+from typing import List, Tuple, Iterator, Deque, Set
 
-from .base import BaseFilePlugin, PluginFail, HandlerExit, HandlerFail
+from .base import BaseFilePlugin, PluginContext, PluginFail, HandlerExit, HandlerFail
+from .clipboard import ClipboardService
 from ..common import *
+from ..common.compression import COMPRESSION_METHODS, compression_method, compression_suffix, decompress_file
+from ..common.merge import merge3, append_dedupe
+
+
+def path_key(name: str) -> Tuple[str, ...]:
+    """Sort key for names in directory sync manifest - compare by path components"""
+    return tuple(name.split('/'))
+
+
+def iter_sorted_fs(base: str, prefix: str = '') -> Iterator[Tuple[str, int, bool, int]]:
+    """Walk directory subtree lazily in order of path components, directory goes before its content"""
+    try:
+        with os.scandir(os.path.join(base, prefix)) as it:
+            entries = sorted(it, key=lambda x: x.name)
+    except OSError:
+        return
+    for entry in entries:
+        name = prefix + entry.name
+        try:
+            is_dir = entry.is_dir()
+            ts = int(entry.stat().st_mtime * 1000)
+        except OSError:
+            continue
+        yield name, ts, is_dir, -2
+        if is_dir and not entry.is_symlink():
+            yield from iter_sorted_fs(base, name + '/')
+
+
+class DirSyncPlanner:
+    """Decide which actions needed to sync directory entries and collect them to lists"""
+
+    def __init__(self, path: str, mode: str, on_conflict: str, on_delete: str, defer_dirs: bool = False):
+        self.path, self.mode, self.on_conflict = path, mode, on_conflict
+        self.do_upload = mode in {'upload', 'sync'}
+        self.do_download = mode in {'download', 'sync'}
+        self.do_delete = on_delete == 'delete'
+        # If set, server directories removed only in the end of session, when all content removed
+        self.deferred_dirs: Optional[List[str]] = list() if defer_dirs else None
+        self.to_upload, self.to_download, self.to_create_c, self.to_create_s = list(), list(), list(), list()
+        self.to_rename_c, self.to_rename_s, self.to_delete_c, self.to_delete_s = list(), list(), list(), list()
+
+    def clear(self):
+        """Drop all collected actions"""
+        for i in self.lists():
+            i.clear()
+
+    def lists(self) -> Tuple[list, ...]:
+        """All lists of actions"""
+        return (self.to_upload, self.to_download, self.to_create_c, self.to_create_s,
+                self.to_rename_c, self.to_rename_s, self.to_delete_c, self.to_delete_s)
+
+    def __len__(self):
+        return sum(map(len, self.lists()))
+
+    def client_only(self, name: str, entry_c: Tuple[str, int, bool, int]):
+        """Plan actions for name existing on client only"""
+        if self.do_upload:
+            if entry_c[2]:
+                self.to_create_s.append(name)
+            else:
+                self.to_upload.append(name)
+        elif self.do_delete:  # download only and deletion allowed
+            self.to_delete_c.append(name)
+
+    def server_only(self, name: str, entry_s: Tuple[str, int, bool, int]):
+        """Plan actions for name existing on server only"""
+        if self.do_download:
+            if entry_s[2]:
+                self.to_create_c.append(name)
+            else:
+                self.to_download.append(name)
+        elif self.do_delete:  # upload only and deletion allowed
+            self.to_delete_s.append(name)
+
+    def both(self, name: str, entry_c: Tuple[str, int, bool, int], entry_s: Tuple[str, int, bool, int]):
+        """Plan actions for name existing on both sides"""
+        on_conflict, mode = self.on_conflict, self.mode
+        if on_conflict not in {'replace', 'new', 'both'}:  # if conflicts ignored - do nothing
+            return
+        _, ts_c, is_dir_c, crc_c = entry_c
+        _, ts_s, is_dir_s, crc_s = entry_s
+        if is_dir_c and is_dir_s:  # both dir already exists, just skip
+            return
+        if mode == 'download':  # from server to client
+            to_c_list = self.to_create_c if is_dir_s else self.to_download
+            if on_conflict == 'replace':
+                self.to_delete_c.append(name)
+                to_c_list.append(name)
+            elif on_conflict == 'new':
+                if ts_s > ts_c:
+                    self.to_delete_c.append(name)
+                    to_c_list.append(name)
+            elif on_conflict == 'both':
+                self.to_rename_c.append(name)
+                to_c_list.append(name)
+        elif mode == 'upload':  # from client to server - sort of mirror for previous
+            to_s_list = self.to_create_s if is_dir_c else self.to_upload
+            if on_conflict == 'replace':
+                self.to_delete_s.append(name)
+                to_s_list.append(name)
+            elif on_conflict == 'new':
+                if ts_c > ts_s:
+                    self.to_delete_s.append(name)
+                    to_s_list.append(name)
+            elif on_conflict == 'both':
+                self.to_rename_s.append((name, ts_s))
+                to_s_list.append(name)
+        elif mode == 'sync':  # priority for client here
+            to_c_list = self.to_create_c if is_dir_s else self.to_download
+            to_s_list = self.to_create_s if is_dir_c else self.to_upload
+            if on_conflict == 'replace':  # replace on client
+                self.to_delete_c.append(name)
+                to_c_list.append(name)
+            elif on_conflict == 'new':
+                if ts_c > ts_s:
+                    self.to_delete_s.append(name)
+                    to_s_list.append(name)
+                else:
+                    self.to_delete_c.append(name)
+                    to_c_list.append(name)
+            elif on_conflict == 'both':
+                if is_dir_c != is_dir_s:
+                    # Don't know what to do in this case
+                    raise PluginFail('Dir-file name conflict')
+                if (not is_dir_c) and (not is_dir_s):
+                    new_name_srv = SyncPlugin.rename_with_mark(self.path, name, f'srv-{ts_s}')
+                    self.to_upload.append(name)
+                    self.to_download.append(new_name_srv)
+
+    def three_way(self, name: str, base: Optional[Tuple[str, int, bool, int]],
+                  entry_c: Optional[Tuple[str, int, bool, int]], deleted_c: bool,
+                  entry_s: Optional[Tuple[str, int, bool, int]], deleted_s: bool):
+        """Plan actions for name using its state on last sync (base) and changes on both sides since then"""
+        changed_c, changed_s = entry_c is not None or deleted_c, entry_s is not None or deleted_s
+        if changed_c and changed_s:
+            if deleted_c and deleted_s:
+                return
+            if deleted_c:  # modification wins over deletion
+                self.server_only(name, entry_s)
+            elif deleted_s:
+                self.client_only(name, entry_c)
+            else:
+                self.both(name, entry_c, entry_s)
+        elif changed_c:
+            if not deleted_c:
+                self.client_only(name, entry_c)
+            elif self.do_delete and self.do_upload:
+                self.to_delete_s.append(name)
+            elif base is not None:  # restore deleted entry on client, unknown names are ignored
+                self.server_only(name, base)
+        elif changed_s:
+            if not deleted_s:
+                if base is not None and not base[2] and self.do_download:
+                    self.to_delete_c.append(name)
+                self.server_only(name, entry_s)
+            elif self.do_delete and self.do_download:
+                self.to_delete_c.append(name)
+            elif base is not None:  # restore deleted entry on server
+                self.client_only(name, base)
+
+    def touched(self) -> Set[str]:
+        """Names of server FS entries which may be changed by sync session"""
+        return {*self.to_upload, *self.to_download, *self.to_create_s, *self.to_delete_s,
+                *(i[0] for i in self.to_rename_s)}
+
+    def log_plan(self, log: Callable, level: int = logging.INFO):
+        """Print collected actions to log"""
+        for title, names in (('To upload from client to server:', self.to_upload),
+                             ('To download from server to client:', self.to_download),
+                             ('To delete on client:', self.to_delete_c),
+                             ('To rename on client:', self.to_rename_c),
+                             ('Dirs to create on client:', self.to_create_c),
+                             ('To delete on server:', self.to_delete_s),
+                             ('To rename on server:', tuple(i[0] for i in self.to_rename_s)),
+                             ('Dirs to create on server:', self.to_create_s)):
+            log(title, level)
+            for name in names:
+                log(f'    {name}', level)
+
+    def apply(self, log: Callable):
+        """Do FS modifications on server"""
+        path = self.path
+        for name, ts in sorted(self.to_rename_s):
+            new_name = SyncPlugin.rename_with_mark(path, name, ts)
+            if path:
+                log(f'Renamed "{name}" -> "{new_name}"')
+        for name in reversed(sorted(self.to_delete_s)):  # reversed order to ensure files removed before parent dirs
+            if self.deferred_dirs is not None and os.path.isdir(os.path.join(path, name)):
+                self.deferred_dirs.append(name)
+                continue
+            SyncPlugin.ensure_removed(path, name)
+            log(f'Removed "{name}"')
+        for name in self.to_create_s:
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+            log(f'Created directory "{name}"')
+
+    def finish(self, log: Callable):
+        """Remove deferred server directories"""
+        for name in reversed(sorted(self.deferred_dirs or (), key=path_key)):
+            SyncPlugin.ensure_removed(self.path, name)
+            log(f'Removed "{name}"')
+
+    def result(self) -> Dict[str, List[str]]:
+        """Actions to do on client side"""
+        return dict(upload=self.to_upload, download=self.to_download, create=self.to_create_c,
+                    delete=self.to_delete_c, rename=self.to_rename_c)
+
+
+class SyncJournal:
+    """Last synced state of server directory for one device, base for three-way incremental sync"""
+
+    def __init__(self, path: str):
+        self.path, self.version = path, 0
+        self.entries: Dict[str, Tuple[int, bool]] = dict()
+
+    def load(self) -> 'SyncJournal':
+        """Load journal from file if one exists"""
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.version = data['version']
+            self.entries = {name: (ts, is_dir) for name, (ts, is_dir) in data['entries'].items()}
+        return self
+
+    def save(self):
+        """Atomically write journal to file"""
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(version=self.version, entries=self.entries), f, separators=(',', ':'))
+        os.replace(tmp_path, self.path)
+
+    def entry(self, name: str) -> Optional[Tuple[str, int, bool, int]]:
+        """Get journal entry in flat FS format"""
+        entry = self.entries.get(name)
+        return None if entry is None else (name, entry[0], entry[1], -2)
+
+    def changes(self, flat_s: Dict[str, Tuple[str, int, bool, int]]) -> Tuple[Set[str], Set[str]]:
+        """Get names changed and deleted on server since journal version"""
+        changed = set()
+        for name, (_, ts, is_dir, _) in flat_s.items():
+            entry = self.entries.get(name)
+            # Timestamps of directories change with content, so only presence of directory matters
+            if entry is None or entry[1] != is_dir or (not is_dir and entry[0] != ts):
+                changed.add(name)
+        return changed, self.entries.keys() - flat_s.keys()
+
+    def update(self, base: str, flat_s: Dict[str, Tuple[str, int, bool, int]], touched: Iterable[str]):
+        """Create next version of journal from server state and names changed by sync session"""
+        self.entries = {name: (ts, is_dir) for name, ts, is_dir, _ in flat_s.values()}
+        for name in touched:
+            try:
+                stat = os.stat(os.path.join(base, name))
+            except OSError:
+                self.entries.pop(name, None)
+            else:
+                self.entries[name] = int(stat.st_mtime * 1000), S_ISDIR(stat.st_mode)
+        self.version += 1
+
+
+class DirListSession:
+    """Paginated directory sync session: merge sorted client manifest pages with sorted server FS walk.
+    Next page of manifest is accepted only when previous one processed, so at most one page is pending"""
+    MAX_ENTRIES = 1 << 24  # max count of entries in client manifest
+
+    def __init__(self, path: str, server: Iterator[Tuple[str, int, bool, int]], planner: DirSyncPlanner):
+        self.path, self.server, self.planner = path, server, planner
+        self.pending: Deque[Tuple[Tuple[str, ...], Tuple[str, int, bool, int]]] = deque()
+        self.last_key: Tuple[str, ...] = ()
+        self.client_done = self.done = self.more = False
+        self.count = 0
+        self.head_s = self.next_server()
+
+    def next_server(self) -> Optional[Tuple[Tuple[str, ...], Tuple[str, int, bool, int]]]:
+        """Get next entry of server FS subtree with sort key"""
+        entry = next(self.server, None)
+        return None if entry is None else (path_key(entry[0]), entry)
+
+    def feed(self, data: list, last: bool):
+        """Add page of client manifest"""
+        if self.client_done and data:
+            raise ValueError('Manifest already finished')
+        if self.more and data:
+            raise ValueError('Rest of plan must be requested before next page of manifest')
+        self.count += len(data)
+        if self.count > self.MAX_ENTRIES:
+            raise ValueError('Too many entries in manifest')
+        for i in data:
+            key = path_key(i[0])
+            if key <= self.last_key:
+                raise ValueError(f'Manifest is not sorted: "{i[0]}"')
+            self.last_key = key
+            self.pending.append((key, (i[0], i[1], i[2] == -1, i[2])))
+        self.client_done = self.client_done or last
+
+    def advance(self, limit: int) -> bool:
+        """Compare entries until plan page is full or next client page needed, return True if plan page is full"""
+        planner, pending = self.planner, self.pending
+        while len(planner) < limit:
+            head_s = self.head_s
+            if pending:
+                key_c, entry_c = pending[0]
+                if head_s is None or key_c < head_s[0]:
+                    planner.client_only(entry_c[0], entry_c)
+                    pending.popleft()
+                elif key_c == head_s[0]:
+                    planner.both(entry_c[0], entry_c, head_s[1])
+                    pending.popleft()
+                    self.head_s = self.next_server()
+                else:
+                    planner.server_only(head_s[1][0], head_s[1])
+                    self.head_s = self.next_server()
+            elif self.client_done:
+                if head_s is None:
+                    self.done = True
+                    self.more = False
+                    return False
+                planner.server_only(head_s[1][0], head_s[1])
+                self.head_s = self.next_server()
+            else:
+                self.more = False
+                return False
+        self.more = True
+        return True
+
+
+class SyncContext(PluginContext):
+    """Sync plugin config with sets of allowed paths and clipboards indexed by ID"""
+
+    def __init__(self, conf: Dict[str, Any]):
+        super().__init__(conf)
+        self.targets = MappingProxyType({sub: tuple(str(i[key]) for i in self.conf.get(sub) or ())
+                                         for sub, key in (('dir', 'path'), ('file', 'path'),
+                                                          ('clipboard', 'clipboard'))})
+        self.dir_paths = frozenset(self.targets['dir'])
+        clipboards = dict()
+        for entry in self.conf.get('clipboard') or ():
+            clipboards.setdefault(entry['clipboard'], entry)
+        self.clipboards = MappingProxyType(clipboards)
 
 
 class SyncPlugin(BaseFilePlugin):
@@ -24,11 +369,16 @@ class SyncPlugin(BaseFilePlugin):
     FILE_CONFIG_SCHEMA = DictEntry('file', 'File, available for sync', False, entries=(
         StringEntry('name', 'Short name for file', False, 0, 60, 'Some dir'),
         FileEntry('path', 'Path to file', False, '/tmp/dcnnt/sync/dcnnt-example.txt', False, False),
+        ChoiceEntry('merge', 'Merge strategy: shell - use on_merge command, merge3 - line-based three-way merge, '
+                             'append - append new lines, newest - newest version wins',
+                    True, ('shell', 'merge3', 'append', 'newest'), 'shell'),
         TemplateEntry('on_merge', 'Template of command executed on merge task to merge local and remote files',
                       True, 0, 4096, default='cat "{local}" "{remote}" > "{output}"',
                       replacements=(Rep('local', 'Path to local version of file', True),
                                     Rep('remote', 'Path to remote version of file', True),
                                     Rep('output', 'Path to save merged file', True),)),
+        IntEntry('max_merge_size', 'Max size in MiB of file merged by built-in strategy in memory, '
+                                   'bigger files are merged by on_merge command', True, 1, 65536, 16),
         TemplateEntry('on_done', 'Template of command executed on sync task completion',
                       True, 0, 4096, None, replacements=(Rep('path', 'Path to saved file', True),)),
     ))
@@ -42,6 +392,10 @@ class SyncPlugin(BaseFilePlugin):
                       True, 0, 4096, None, replacements=(Rep('clipboard', 'Clipboard ID/name', True),)),
         TemplateEntry('write', 'Template of command executed to write to clipboard (should read content from stdin)',
                       True, 0, 4096, None, replacements=(Rep('clipboard', 'Clipboard ID/name', True),)),
+        TemplateEntry('watch', 'Template of long-running command printing line on every clipboard change',
+                      True, 0, 4096, None, replacements=(Rep('clipboard', 'Clipboard ID/name', True),)),
+        IntEntry('poll_interval', 'Time in milliseconds to use cached content if no watch command',
+                 True, 0, 3600000, 500),
     ))
     CLIPBOARD_CONFIG_DEFAULT = (dict(name='Clipboard',
                                      clipboard='clipboard',
@@ -51,37 +405,56 @@ class SyncPlugin(BaseFilePlugin):
         IntEntry('uin', 'UIN of device for which config will be applied', True, 1, 0xFFFFFFF, None),
         DirEntry('working_directory', 'Directory to store temporary files',
                  True, '/tmp/dcnnt/sync_tmp', True, False),
+        DirEntry('journal_directory', 'Directory to store last synced state of directories',
+                 True, '$DCNNT_CONFIG_DIR/sync_journal', True, False),
         ListEntry('dir', 'List of directories available for sync', False, 0, 0xFFFF,
                   DIR_CONFIG_DEFAULT, entry=DIR_CONFIG_SCHEMA),
         ListEntry('file', 'List of files available for sync', False, 0, 0xFFFF,
                   FILE_CONFIG_DEFAULT, entry=FILE_CONFIG_SCHEMA),
         ListEntry('clipboard', 'List of clipboards available for sync', False, 0, 0xFFFF,
-                  CLIPBOARD_CONFIG_DEFAULT, entry=FILE_CONFIG_SCHEMA),
+                  CLIPBOARD_CONFIG_DEFAULT, entry=CLIPBOARD_CONFIG_SCHEMA),
         DictEntry('contacts', 'Contacts sync settings', False, entries=(
             DirEntry('path', 'Directory to store vcard files', False, '/tmp/dcnnt/sync/contacts', True, False),
             IntEntry('backup_count', 'Count of backup files', False, 0, 4096, 3),
+            IntEntry('backup_max_age', 'Max age of backup files in days, 0 - unlimited', True, 0, 36500, 0),
+            BoolEntry('backup_store', 'Keep each distinct backup once, generations are hard links to it',
+                      True, False),
+            ChoiceEntry('compression', 'Compression of stored files', True, COMPRESSION_METHODS, 'none'),
             TemplateEntry('on_done', 'Template of command executed on sync task completion',
                           True, 0, 4096, None, replacements=(Rep('path', 'Path to saved file', True),)),
         )),
         DictEntry('messages', 'SMS sync settings', True, entries=(
             DirEntry('path', 'Directory to store messages files', False, '/tmp/dcnnt/sync/messages', True, False),
             IntEntry('backup_count', 'Count of backup files', False, 0, 4096, 3),
+            IntEntry('backup_max_age', 'Max age of backup files in days, 0 - unlimited', True, 0, 36500, 0),
+            BoolEntry('backup_store', 'Keep each distinct backup once, generations are hard links to it',
+                      True, False),
+            ChoiceEntry('compression', 'Compression of stored files', True, COMPRESSION_METHODS, 'none'),
             TemplateEntry('on_done', 'Template of command executed on sync task completion',
                           True, 0, 4096, None, replacements=(Rep('path', 'Path to the last saved file', True),)),
         ))
     ))
 
+    CONTEXT_CLASS = SyncContext
+    MANIFEST_PAGE = 4096  # max count of entries in one page of paginated manifest or sync plan
+    JOURNAL_SESSIONS = 4  # max count of sync sessions waiting for commit in one connection
+    JOURNAL_SESSION_TTL = 3600  # seconds to wait for commit of sync session
+    BACKUP_STORE_DIR = '.store'
+
     def __init__(self, app, handler, device):
         super().__init__(app, handler, device)
+        self.dir_sessions: Dict[str, DirListSession] = dict()
+        self.journal_sessions: Dict[str, Tuple[float, SyncJournal, str, Dict[str, Tuple[str, int, bool, int]],
+                                               Set[str]]] = dict()
 
     def handle_targets(self, request: RPCRequest):
         """Return list of sync entries to device"""
         sub = request.params.get('sub')
         if not isinstance(sub, str):
             raise PluginFail('No "sub" param in request')
-        entries = self.conf((sub, ))
-        key = 'clipboard' if sub == 'clipboard' else 'path'
-        self.rpc_send(RPCResponse(request.id, tuple(str(i[key]) for i in entries)))
+        if sub not in self.context.targets:
+            raise PluginFail(f'Unknown sync entries type "{sub}"')
+        self.rpc_send(RPCResponse(request.id, self.context.targets[sub]))
 
     @staticmethod
     def get_flat_fs(base: str) -> Dict[str, Tuple[str, int, bool, int]]:
@@ -140,23 +513,24 @@ class SyncPlugin(BaseFilePlugin):
             else:
                 os.unlink(path)
 
-    def handle_dir_list(self, request: RPCRequest):
-        """Initialize directory sync session"""
-        args = 'data', 'mode', 'path', 'on_conflict', 'on_delete'
-        flat_list_c, mode, path, on_conflict, on_delete = map(request.params.get, args)
-        for name, value in zip(args[1:], (mode, path, on_conflict, on_delete)):
+    def check_dir_list_params(self, request: RPCRequest) -> Tuple[str, str, str, str]:
+        """Check common params of directory sync session"""
+        args = 'mode', 'path', 'on_conflict', 'on_delete'
+        values = tuple(map(request.params.get, args))
+        for name, value in zip(args, values):
             if not isinstance(value, str):
                 raise PluginFail(f'No correct "{name}" param in request')
-        if path not in tuple(str(i['path']) for i in self.conf(('dir', ))):
+        if values[1] not in self.context.dir_paths:
             raise PluginFail('Unknown target path')
-        do_upload = mode in {'upload', 'sync'}
-        do_download = mode in {'download', 'sync'}
-        do_delete = on_delete == 'delete'
+        return values
+
+    def handle_dir_list(self, request: RPCRequest):
+        """Initialize directory sync session"""
+        mode, path, on_conflict, on_delete = self.check_dir_list_params(request)
+        flat_list_c = request.params.get('data')
         self.log(f'Process {len(flat_list_c)} names, mode: "{mode}", target: "{path}", '
                  f'on conflict: "{on_conflict}", on delete: "{on_delete}"')
-        # Lists of entries by actions
-        to_upload, to_download, to_create_c, to_create_s = list(), list(), list(), list()
-        to_rename_c, to_rename_s, to_delete_c, to_delete_s = list(), list(), list(), list()
+        planner = DirSyncPlanner(path, mode, on_conflict, on_delete)
         # Flat data of FS subtree for server and client
         flat_c: Dict[str, Tuple[str, int, bool, int]] = {i[0]: (i[0], i[1], i[2] == -1, i[2]) for i in flat_list_c}
         flat_s: Dict[str, Tuple[str, int, bool, int]] = self.get_flat_fs(path)
@@ -180,119 +554,115 @@ class SyncPlugin(BaseFilePlugin):
             self.log(f'    {name}')
         # Process 3 groups of names
         for name in names_client_only:
-            if do_upload:
-                if flat_c[name][2]:
-                    to_create_s.append(name)
-                else:
-                    to_upload.append(name)
-            elif do_delete:  # download only and deletion allowed
-                to_delete_c.append(name)
+            planner.client_only(name, flat_c[name])
         for name in names_server_only:
-            if do_download:
-                if flat_s[name][2]:
-                    to_create_c.append(name)
-                else:
-                    to_download.append(name)
-            elif do_delete:  # upload only and deletion allowed
-                to_delete_s.append(name)
-        if on_conflict in {'replace', 'new', 'both'}:  # if conflicts ignored - do nothing
-            for name in names_both:
-                _, ts_c, is_dir_c, crc_c = flat_c[name]
-                _, ts_s, is_dir_s, crc_s = flat_s[name]
-                if is_dir_c and is_dir_s:  # both dir already exists, just skip
-                    continue
-                if mode == 'download':  # from server to client
-                    to_c_list = to_create_c if is_dir_s else to_download
-                    if on_conflict == 'replace':
-                        to_delete_c.append(name)
-                        to_c_list.append(name)
-                    elif on_conflict == 'new':
-                        if ts_s > ts_c:
-                            to_delete_c.append(name)
-                            to_c_list.append(name)
-                    elif on_conflict == 'both':
-                        to_rename_c.append(name)
-                        to_c_list.append(name)
-                elif mode == 'upload':  # from client to server - sort of mirror for previous
-                    to_s_list = to_create_s if is_dir_c else to_upload
-                    if on_conflict == 'replace':
-                        to_delete_s.append(name)
-                        to_s_list.append(name)
-                    elif on_conflict == 'new':
-                        if ts_c > ts_s:
-                            to_delete_s.append(name)
-                            to_s_list.append(name)
-                    elif on_conflict == 'both':
-                        to_rename_s.append(name)
-                        to_s_list.append(name)
-                elif mode == 'sync':  # priority for client here
-                    to_c_list = to_create_c if is_dir_s else to_download
-                    to_s_list = to_create_s if is_dir_c else to_upload
-                    if on_conflict == 'replace':  # replace on client
-                        to_delete_c.append(name)
-                        to_c_list.append(name)
-                    elif on_conflict == 'new':
-                        if ts_c > ts_s:
-                            to_delete_s.append(name)
-                            to_s_list.append(name)
-                        else:
-                            to_delete_c.append(name)
-                            to_c_list.append(name)
-                    elif on_conflict == 'both':
-                        if is_dir_c != is_dir_s:
-                            # Don't know what to do in this case
-                            raise PluginFail('Dir-file name conflict')
-                        if (not is_dir_c) and (not is_dir_s):
-                            srv_ts = flat_s[name][1]
-                            new_name_srv = self.rename_with_mark(path, name, f'srv-{srv_ts}')
-                            to_upload.append(name)
-                            to_download.append(new_name_srv)
+            planner.server_only(name, flat_s[name])
+        for name in names_both:
+            planner.both(name, flat_c[name], flat_s[name])
         # Print some info to logs
-        self.log('To upload from client to server:')
-        for name in to_upload:
-            self.log(f'    {name}')
-        self.log('To download from server to client:')
-        for name in to_download:
-            self.log(f'    {name}')
-        self.log('To delete on client:')
-        for name in to_delete_c:
-            self.log(f'    {name}')
-        self.log('To rename on client:')
-        for name in to_rename_c:
-            self.log(f'    {name}')
-        self.log('Dirs to create on client:')
-        for name in to_create_c:
-            self.log(f'    {name}')
-        self.log('To delete on server:')
-        for name in to_delete_s:
-            self.log(f'    {name}')
-        self.log('To rename on server:')
-        for name in to_rename_s:
-            self.log(f'    {name}')
-        self.log('Dirs to create on server:')
-        for name in to_create_s:
-            self.log(f'    {name}')
+        planner.log_plan(self.log)
         # Do FS modifications on server
-        for name in sorted(to_rename_s):
-            new_name = self.rename_with_mark(path, name, flat_s[name][1])
-            if path:
-                self.log(f'Renamed "{name}" -> "{new_name}"')
-        for name in reversed(sorted(to_delete_s)):  # reversed order to ensure files removed before parent dirs
-            self.ensure_removed(path, name)
-            self.log(f'Removed "{name}"')
-        for name in to_create_s:
-            os.makedirs(os.path.join(path, name), exist_ok=True)
-            self.log(f'Created directory "{name}"')
+        planner.apply(self.log)
         # Send response to server
         session_id = f'{time.time()}.{id(request)}'
-        self.rpc_send(RPCResponse(request.id, dict(upload=to_upload, download=to_download, create=to_create_c,
-                                                   delete=to_delete_c, rename=to_rename_c, session=session_id)))
+        if request.params.get('journal'):
+            self.add_journal_session(session_id, self.journal(path), path, flat_s, planner.touched())
+        self.rpc_send(RPCResponse(request.id, dict(**planner.result(), session=session_id)))
+
+    def add_journal_session(self, session_id: str, journal: SyncJournal, path: str,
+                            flat_s: Dict[str, Tuple[str, int, bool, int]], touched: Set[str]):
+        """Keep server state of sync session until commit, expired and oldest sessions are dropped"""
+        now = time.monotonic()
+        for key, session in tuple(self.journal_sessions.items()):
+            if now - session[0] > self.JOURNAL_SESSION_TTL or len(self.journal_sessions) >= self.JOURNAL_SESSIONS:
+                del self.journal_sessions[key]
+        self.journal_sessions[session_id] = now, journal, path, flat_s, touched
+
+    def journal(self, path: str) -> SyncJournal:
+        """Load sync journal of directory for current device"""
+        filename = f'{self.device.uin}.{hashlib.sha1(path.encode()).hexdigest()[:16]}.json'
+        return SyncJournal(os.path.join(self.conf('journal_directory'), filename)).load()
+
+    def handle_dir_sync_changes(self, request: RPCRequest):
+        """Incremental directory sync: client sends only changes since last synced journal version"""
+        mode, path, on_conflict, on_delete = self.check_dir_list_params(request)
+        version, changes, deleted = map(request.params.get, ('version', 'changes', 'deleted'))
+        if not isinstance(changes, list) or not isinstance(deleted, list):
+            raise PluginFail('Incorrect args "changes" or "deleted"')
+        journal = self.journal(path)
+        if journal.version == 0 or version != journal.version:
+            raise HandlerExit(RPCResponse(request.id, dict(code=3, message='Journal version mismatch',
+                                                           version=journal.version)))
+        planner = DirSyncPlanner(path, mode, on_conflict, on_delete)
+        flat_s = self.get_flat_fs(path)
+        changed_s, deleted_s = journal.changes(flat_s)
+        changed_c = {i[0]: (i[0], i[1], i[2] == -1, i[2]) for i in changes}
+        deleted_c = set(deleted) - changed_c.keys()
+        self.log(f'Incremental sync of "{path}" from version {version}, changed on client: {len(changed_c)}, '
+                 f'deleted on client: {len(deleted_c)}, changed on server: {len(changed_s)}, '
+                 f'deleted on server: {len(deleted_s)}')
+        for name in sorted(changed_c.keys() | deleted_c | changed_s | deleted_s):
+            planner.three_way(name, journal.entry(name), changed_c.get(name), name in deleted_c,
+                              flat_s[name] if name in changed_s else None, name in deleted_s)
+        planner.log_plan(self.log)
+        planner.apply(self.log)
+        session_id = f'{time.time()}.{id(request)}'
+        self.add_journal_session(session_id, journal, path, flat_s, planner.touched())
+        self.rpc_send(RPCResponse(request.id, dict(**planner.result(), session=session_id, version=journal.version)))
+
+    def handle_dir_sync_commit(self, request: RPCRequest):
+        """Save state of directory to journal when all files of sync session transferred"""
+        session = self.journal_sessions.pop(request.params.get('session'), None)
+        if session is None:
+            raise HandlerExit.new(request, 1, 'No such session')
+        _, journal, path, flat_s, touched = session
+        journal.update(path, flat_s, touched)
+        journal.save()
+        self.log(f'Sync journal of "{path}" saved, version {journal.version}')
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK', version=journal.version)))
+
+    def handle_dir_list_begin(self, request: RPCRequest):
+        """Initialize paginated directory sync session, client manifest will be sent in next requests"""
+        mode, path, on_conflict, on_delete = self.check_dir_list_params(request)
+        session_id = f'{time.time()}.{id(request)}'
+        self.log(f'Start paginated session {session_id}, mode: "{mode}", target: "{path}", '
+                 f'on conflict: "{on_conflict}", on delete: "{on_delete}"')
+        self.dir_sessions[session_id] = DirListSession(path, iter_sorted_fs(path),
+                                                       DirSyncPlanner(path, mode, on_conflict, on_delete, True))
+        self.rpc_send(RPCResponse(request.id, dict(code=0, message='OK', session=session_id,
+                                                   page=self.MANIFEST_PAGE)))
+
+    def handle_dir_list_page(self, request: RPCRequest):
+        """Process page of client manifest sorted by path components, return next page of sync plan"""
+        session_id, data, last = map(request.params.get, ('session', 'data', 'last'))
+        session: Optional[DirListSession] = self.dir_sessions.get(session_id)
+        if session is None:
+            raise HandlerExit.new(request, 1, 'No such session')
+        if not isinstance(data, list) or len(data) > self.MANIFEST_PAGE:
+            raise PluginFail('Incorrect arg "data"')
+        try:
+            session.feed(data, bool(last))
+        except ValueError as e:
+            del self.dir_sessions[session_id]
+            raise HandlerExit.new(request, 2, str(e))
+        more = session.advance(self.MANIFEST_PAGE)
+        planner = session.planner
+        self.log(f'Session {session_id}: {len(data)} names received, {len(planner)} actions planned')
+        planner.log_plan(self.log, logging.DEBUG)
+        planner.apply(self.log)
+        if session.done:
+            planner.finish(self.log)
+            del self.dir_sessions[session_id]
+            self.log(f'Session {session_id}: manifest processed')
+        self.rpc_send(RPCResponse(request.id, dict(**planner.result(), session=session_id, more=more,
+                                                   done=session.done)))
+        planner.clear()
 
     def handle_dir_upload(self, request: RPCRequest):
         """Process uploading file on dir sync"""
         print(request.params)
         base = request.params.get('path')
-        if base not in tuple(str(i['path']) for i in self.conf(('dir',))):
+        if base not in self.context.dir_paths:
             raise PluginFail('Unknown target path')
         self.receive_file(request, base)
 
@@ -300,13 +670,74 @@ class SyncPlugin(BaseFilePlugin):
         """Process downloading file on dir sync"""
         base = request.params.get('path')
         name = request.params.get('name')
-        if base not in tuple(str(i['path']) for i in self.conf(('dir',))):
+        if base not in self.context.dir_paths:
             raise PluginFail('Unknown target path')
         if not isinstance(name, str):
             raise PluginFail('Incorrect arg "name"')
         path = os.path.join(base, name)
         self.send_file(request, path)
 
+    def handle_dir_download_batch(self, request: RPCRequest):
+        """Process downloading of many files on dir sync in one request"""
+        base = request.params.get('path')
+        names = request.params.get('names')
+        if base not in self.context.dir_paths:
+            raise PluginFail('Unknown target path')
+        if not isinstance(names, list):
+            raise PluginFail('Incorrect arg "names"')
+        paths = [os.path.join(base, name) if isinstance(name, str) else None for name in names]
+        self.log(f'Sending {len(names)} files from "{base}"')
+        self.send_files_batch(request, names, paths)
+
+    @staticmethod
+    def backup_suffixes(backup_count: int) -> Tuple[str, ...]:
+        """Suffixes of backup files from oldest to current one"""
+        return tuple(f'.{i}.bak' for i in reversed(range(backup_count))) + ('', )
+
+    def rotate_backups(self, directory: str, fn: str, backup_count: int):
+        """Shift backup generations by renaming, current file becomes the newest backup"""
+        if backup_count <= 0:
+            return
+        suffixes = self.backup_suffixes(backup_count)
+        for i in range(len(suffixes) - 1):
+            src = os.path.join(directory, fn + suffixes[i + 1])
+            dst = os.path.join(directory, fn + suffixes[i])
+            if os.path.isfile(src):
+                os.replace(src, dst)
+
+    def store_backup(self, directory: str, path: str):
+        """Replace received file with hard link to content-addressed copy, so every distinct version stored once"""
+        store = os.path.join(directory, self.BACKUP_STORE_DIR)
+        os.makedirs(store, exist_ok=True)
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.PART), b''):
+                digest.update(chunk)
+        stored_path = os.path.join(store, digest.hexdigest())
+        if os.path.isfile(stored_path):
+            tmp_path = f'{path}.link'
+            os.link(stored_path, tmp_path)
+            os.replace(tmp_path, path)
+            os.utime(stored_path)  # age of stored copy is time of last upload of the same content
+        else:
+            os.link(path, stored_path)
+
+    def prune_backups(self, directory: str, fn: str, backup_count: int, max_age: Optional[int]):
+        """Remove expired backup generations and stored copies without generations linked"""
+        if max_age:
+            min_ts = time.time() - max_age * 86400
+            for suffix in self.backup_suffixes(backup_count)[:-1]:
+                path = os.path.join(directory, fn + suffix)
+                if os.path.isfile(path) and os.path.getmtime(path) < min_ts:
+                    os.unlink(path)
+                    self.log(f'Removed expired backup "{path}"')
+        store = os.path.join(directory, self.BACKUP_STORE_DIR)
+        if os.path.isdir(store):
+            with os.scandir(store) as it:
+                for entry in it:
+                    if entry.is_file() and entry.stat().st_nlink <= 1:
+                        os.unlink(entry.path)
+
     def common_upload_handler(self, entity_type: str, request: RPCRequest):
         """Process any backup uploading"""
         directory = self.conf((entity_type, 'path'))
@@ -319,18 +750,61 @@ class SyncPlugin(BaseFilePlugin):
         if isinstance(total, int) and isinstance(index, int):
             if total - index == 1:  # indexes starts from 0 on client
                 is_last_entry = True
-        if backup_count > 0:
-            suffixes = tuple(f'.{i}.bak' for i in reversed(range(backup_count))) + ('', )
-            for i in range(len(suffixes) - 1):
-                src = os.path.join(directory, fn + suffixes[i + 1])
-                dst = os.path.join(directory, fn + suffixes[i])
-                if os.path.isfile(src):
-                    shutil.copy(src, dst)
-        res = self.receive_file(request, directory)
+        compression = compression_method(self.conf((entity_type, 'compression')))
+        stored_fn = fn + compression_suffix(compression)
+        # Backups are rotated only when new version received completely
+        res = self.receive_file(request, directory, compression,
+                                lambda path: self.rotate_backups(directory, stored_fn, backup_count))
+        if self.conf((entity_type, 'backup_store')):
+            self.store_backup(directory, res)
+        self.prune_backups(directory, stored_fn, backup_count, self.conf((entity_type, 'backup_max_age')))
         if on_done and is_last_entry:
-            command = on_done.format(path=res)
-            self.log(f'Execute: "{command}"')
-            subprocess.call(command, shell=True)
+            path = self.plain_copy(entity_type, res, compression, fn)
+            cleanup = None if path == res else lambda: self.remove_plain_copy(path)
+            self.app.hooks.submit(on_done, on_done.format(path=path), path, cleanup=cleanup)
+
+    def plain_copy(self, entity_type: str, path: str, compression: Optional[str], name: str) -> str:
+        """Get path to decompressed version of stored file, decompressed copy named as original file
+        is created in own temporary directory in runtime directory"""
+        if compression is None:
+            return path
+        directory = os.path.join(self.app.environment['DCNNT_RUNTIME_DIR'], 'plain', entity_type)
+        os.makedirs(directory, exist_ok=True)
+        plain_path = os.path.join(tempfile.mkdtemp(dir=directory), os.path.basename(name))
+        try:
+            decompress_file(path, compression, plain_path, self.PART)
+        except BaseException:
+            self.remove_plain_copy(plain_path)
+            raise
+        return plain_path
+
+    @staticmethod
+    def remove_plain_copy(plain_path: str):
+        """Remove decompressed copy of stored file with its temporary directory"""
+        shutil.rmtree(os.path.dirname(plain_path), ignore_errors=True)
+
+    def handle_backup_download(self, request: RPCRequest):
+        """Send contacts or messages backup file back to client, decompressed"""
+        entity_type, name, generation = map(request.params.get, ('entity', 'name', 'generation'))
+        if entity_type not in {'contacts', 'messages'} or not isinstance(name, str):
+            raise PluginFail('Incorrect args "entity" or "name"')
+        if generation is not None and not isinstance(generation, int):
+            raise PluginFail('Incorrect arg "generation"')
+        directory = self.conf((entity_type, 'path'))
+        backup_suffix = '' if generation is None else f'.{generation}.bak'
+        configured = compression_method(self.conf((entity_type, 'compression')))
+        for compression in (configured, *(compression_method(i) for i in COMPRESSION_METHODS)):
+            path = os.path.join(directory, os.path.basename(name) + compression_suffix(compression) + backup_suffix)
+            if os.path.isfile(path):
+                break
+        else:
+            raise HandlerExit.new(request, 2, 'No such file')
+        plain_path = self.plain_copy(entity_type, path, compression, name)
+        try:
+            self.send_file(request, plain_path)
+        finally:
+            if plain_path != path:
+                self.remove_plain_copy(plain_path)
 
     def handle_contacts_upload(self, request: RPCRequest):
         """Process contacts backup uploading"""
@@ -340,17 +814,72 @@ class SyncPlugin(BaseFilePlugin):
         """Process messages backup uploading"""
         return self.common_upload_handler('messages', request)
 
-    def ensure_file_syncable(self, path: str) -> Optional[str]:
-        """Check if file in list of sync files and return on_merge option, raise exception otherwise"""
+    def file_conf(self, path: str) -> Dict[str, Any]:
+        """Get config of file sync entry, raise exception if file not in list of sync files"""
         for i in self.conf('file'):
             if path in i['path']:
-                return i.get('on_merge')
+                return i
         raise PluginFail('No file in sync list')
 
+    def merge_base_path(self, path: str) -> str:
+        """Path to copy of file version synced last time, using as base for three-way merge"""
+        directory = os.path.join(self.conf('working_directory'), 'merge_base')
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f'{self.device.uin}.{hashlib.sha1(path.encode()).hexdigest()[:16]}')
+
+    def save_merge_base(self, conf: Dict[str, Any], path: str):
+        """Remember synced version of file if it is needed for merge"""
+        if conf.get('merge') == 'merge3' and os.path.isfile(path):
+            shutil.copyfile(path, self.merge_base_path(path))
+
+    def merge_file(self, request: RPCRequest, strategy: str, path: str, remote: bytes):
+        """Merge version of file received from client with local one using built-in strategy"""
+        local, exists = b'', os.path.isfile(path)
+        if exists:
+            with open(path, 'rb') as f:
+                local = f.read()
+        if strategy == 'newest':
+            ts_remote, ts_local = request.params.get('ts'), int(os.path.getmtime(path) * 1000) if exists else 0
+            merged = local if isinstance(ts_remote, int) and ts_remote < ts_local else remote
+        elif strategy == 'merge3' and os.path.isfile(self.merge_base_path(path)):
+            with open(self.merge_base_path(path), 'rb') as f:
+                base = f.read()
+            lines, conflict = merge3(base.splitlines(True), local.splitlines(True), remote.splitlines(True))
+            if conflict:
+                self.log(f'Merge conflicts in "{path}"', logging.WARNING)
+            merged = b''.join(lines)
+        else:
+            if strategy == 'merge3':
+                self.log(f'No base version of "{path}" to merge, lines appended')
+            merged = b''.join(append_dedupe(local.splitlines(True), remote.splitlines(True)))
+        if merged == local:
+            return
+        directory, filename = os.path.split(os.path.realpath(path))
+        path = os.path.join(directory, filename)
+        tmp_path = os.path.join(directory, f'.{filename}.{secrets.token_hex(4)}.part')
+        try:
+            with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666), 'wb') as f:
+                f.write(merged)
+            self._copy_mode(path, tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def merge_in_memory(self, conf: Dict[str, Any], request: RPCRequest, path: str) -> bool:
+        """Check if versions of file are small enough to be merged by built-in strategy in memory"""
+        limit, size = conf['max_merge_size'] << 20, request.params.get('size')
+        sizes = [os.path.getsize(i) for i in (path, self.merge_base_path(path)) if os.path.isfile(i)]
+        if not isinstance(size, int) or max(sizes + [size]) > limit:
+            self.log(f'File "{path}" is too big to merge in memory, on_merge command used', logging.WARNING)
+            return False
+        return True
+
     def handle_file_info(self, request: RPCRequest):
         """Send some info about sync file to client"""
         path = str(request.params['path'])
-        self.ensure_file_syncable(path)
+        self.file_conf(path)
         exists = os.path.isfile(path)
         ts = int(os.path.getmtime(path) * 1000 + .5) if exists else 0
         self.rpc_send(RPCResponse(request.id, {'exists': exists, 'ts': ts}))
@@ -359,8 +888,11 @@ class SyncPlugin(BaseFilePlugin):
         """Process uploading file on file sync"""
         path = str(request.params.get('path'))
         merge_mode = bool(request.params.get('merge'))
-        on_merge = self.ensure_file_syncable(path)
-        if merge_mode:
+        conf = self.file_conf(path)
+        on_merge, strategy = conf.get('on_merge'), conf.get('merge')
+        if merge_mode and strategy != 'shell' and self.merge_in_memory(conf, request, path):
+            self.merge_file(request, strategy, path, self.receive_file_to_buffer(request))
+        elif merge_mode:
             if on_merge is None:
                 raise PluginFail('No merge script set')
             random = str(int(time.time() * 1000)) + str(id(path))
@@ -376,18 +908,18 @@ class SyncPlugin(BaseFilePlugin):
             subprocess.call(command, shell=True)
         else:
             self.receive_file_to_path(request, path)
+        self.save_merge_base(conf, path)
 
     def handle_file_download(self, request: RPCRequest):
         """Process downloading file on file sync"""
         path = request.params.get('path')
-        self.ensure_file_syncable(path)
+        conf = self.file_conf(path)
         self.send_file(request, path)
+        self.save_merge_base(conf, path)
 
     def conf_clipboard(self, clipboard_id: str) -> Optional[Dict[str, str]]:
         """Get config for clipboard sync entry"""
-        for conf in self.conf('clipboard'):
-            if clipboard_id == conf['clipboard']:
-                return conf
+        return self.context.clipboards.get(clipboard_id)
 
     def handle_clipboard(self, request: RPCRequest):
         """Process clipboard fetch or send request"""
@@ -396,13 +928,11 @@ class SyncPlugin(BaseFilePlugin):
         if conf is None:
             raise HandlerExit.new(request, 1, 'No such clipboard')
         if request.method == 'clipboard_fetch':
-            cmd = conf['read'].format(clipboard=clipboard_id)
-            text = subprocess.check_output(cmd, timeout=15, shell=True).decode(errors='ignore')
-            return self.rpc_send(RPCResponse(request.id, {'code': 0, 'text': text}))
+            return self.rpc_send(ClipboardService.read_response(self.log, request, conf, clipboard_id))
         elif request.method == 'clipboard_send':
             cmd = conf['write'].format(clipboard=clipboard_id)
             try:
-                subprocess.run(cmd, shell=True, timeout=15, input=request.params['text'].encode(errors='ignore'))
+                ClipboardService.get(self.log, conf, clipboard_id).write(cmd, request.params['text'])
             except Exception as e:
                 return self.rpc_send(RPCResponse(request.id, {'code': 1, 'message': f'Error: {e}'}))
             return self.rpc_send(RPCResponse(request.id, {'code': 0, 'message': 'OK'}))
@@ -414,14 +944,26 @@ class SyncPlugin(BaseFilePlugin):
             self.handle_targets(request)
         elif request.method == 'dir_list':
             self.handle_dir_list(request)
+        elif request.method == 'dir_list_begin':
+            self.handle_dir_list_begin(request)
+        elif request.method == 'dir_list_page':
+            self.handle_dir_list_page(request)
+        elif request.method == 'dir_sync_changes':
+            self.handle_dir_sync_changes(request)
+        elif request.method == 'dir_sync_commit':
+            self.handle_dir_sync_commit(request)
         elif request.method == 'dir_upload':
             self.handle_dir_upload(request)
         elif request.method == 'dir_download':
             self.handle_dir_download(request)
+        elif request.method == 'dir_download_batch':
+            self.handle_dir_download_batch(request)
         elif request.method == 'contacts_upload':
             self.handle_contacts_upload(request)
         elif request.method == 'messages_upload':
             self.handle_messages_upload(request)
+        elif request.method == 'backup_download':
+            self.handle_backup_download(request)
         elif request.method == 'file_info':
             self.handle_file_info(request)
         elif request.method == 'file_upload':
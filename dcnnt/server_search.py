@@ -1,9 +1,13 @@
 """Simple UDP server to response server-search requests from devices"""
 
 import json
+import time
+import socket
+import selectors
 from base64 import b64decode, b64encode
 from threading import Thread
 from socketserver import BaseRequestHandler
+from typing import Dict, Tuple, Optional
 
 from .common import decrypt, encrypt, derive_key
 
@@ -45,3 +49,95 @@ class ServerSearchHandler(BaseRequestHandler):
                                                           derive_key(pairing_code + str(uin)))).decode()
                 response = json.dumps(resp_data)
                 res = socket.sendto(response.encode(), self.client_address)
+
+
+class DiscoveryResponder:
+    """Single-threaded non-blocking responder to server search requests from devices, used out of pairing mode.
+    Response is prepared once, count of responses to one IP is limited, new devices are saved to disk with delay"""
+    MAX_PACKET_SIZE = 8192
+    RATE_LIMIT = 10  # max count of requests from one IP processed per RATE_PERIOD
+    RATE_PERIOD = 1.0
+    MAX_TRACKED_IPS = 4096
+
+    def __init__(self, app, address: Tuple[str, int]):
+        self.app = app
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(address)
+        self.sock.setblocking(False)
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.running = False
+        self.response_cache: Tuple[Optional[dict], bytes] = None, b''
+        self.requests: Dict[str, Tuple[float, int]] = dict()
+
+    def response(self) -> bytes:
+        """Get serialized response, it is re-created after configuration reload only"""
+        info = self.app.conf['self']
+        if self.response_cache[0] is not info:
+            self.response_cache = info, json.dumps(dict(plugin='search', action='response', role='server',
+                                                        uin=info['uin'], name=info['name'])).encode()
+        return self.response_cache[1]
+
+    def allowed(self, ip: str, now: float) -> bool:
+        """Count request from IP, check if it is within rate limit"""
+        start, count = self.requests.get(ip, (now, 0))
+        if now - start >= self.RATE_PERIOD:
+            start, count = now, 0
+        if len(self.requests) >= self.MAX_TRACKED_IPS and ip not in self.requests:
+            self.requests = {k: v for k, v in self.requests.items() if now - v[0] < self.RATE_PERIOD}
+        self.requests[ip] = start, count + 1
+        return count < self.RATE_LIMIT
+
+    def handle(self, raw: bytes, address: Tuple[str, int], now: float):
+        """Process one datagram"""
+        log, ip = self.app.log, address[0]
+        if not self.allowed(ip, now):
+            return
+        try:
+            plugin, action, uin, name, role, _ = ServerSearchHandler.unpack_raw_request(raw)
+        except UnicodeDecodeError:
+            log.warning('Unicode decoding error in UDP request')
+        except json.JSONDecodeError as e:
+            log.warning('JSON decoding error in UDP request: {}'.format(e))
+        except (KeyError, AttributeError) as e:
+            log.warning('Key not found in JSON (UDP request): {}'.format(e))
+        else:
+            if plugin == 'search' and action in 'request':
+                self.app.dm.update_device(uin, ip, name, role)
+                try:
+                    self.sock.sendto(self.response(), address)
+                except OSError as e:
+                    log.debug(f'Search response to {ip} not sent: {e}')
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        """Process requests until shutdown"""
+        self.running = True
+        while self.running:
+            for key, _ in self.selector.select(poll_interval):
+                if key.fileobj is self.wakeup_recv:
+                    self.wakeup_recv.recv(64)
+                    continue
+                now = time.monotonic()
+                while True:
+                    try:
+                        raw, address = self.sock.recvfrom(self.MAX_PACKET_SIZE)
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    except OSError as e:
+                        self.app.log.warning(f'UDP receive error: {e}')
+                        break
+                    self.handle(raw, address, now)
+        self.app.dm.flush()
+
+    def shutdown(self):
+        """Stop serve_forever loop"""
+        self.running = False
+        self.wakeup_send.send(b'\0')
+
+    def server_close(self):
+        """Close sockets"""
+        self.selector.close()
+        for sock in (self.sock, self.wakeup_recv, self.wakeup_send):
+            sock.close()
@@ -8,11 +8,16 @@ from .common import encrypt, decrypt
 class DConnectThreadingTCPServer(ThreadingMixIn, TCPServer):
     """Python TCP server with link to app class"""
 
-    def __init__(self, app, address, handler_cls):
-        self.allow_reuse_address = True
+    def __init__(self, app, address, handler_cls, reuse_port: bool = False):
+        self.allow_reuse_address, self.reuse_port = True, reuse_port
         super().__init__(address, handler_cls)
         self.app = app
 
+    def server_bind(self):
+        if self.reuse_port:  # sockets of all worker processes bound to one port, kernel balances connections
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
 
 class DConnectHandler(BaseRequestHandler):
     """Parse header, do authentication routines, then create plugin instance to work with connection"""
@@ -35,6 +40,8 @@ class DConnectHandler(BaseRequestHandler):
                 data = self.sock.recv(left)
             except socket.timeout:
                 return
+            if not data:  # connection closed by client
+                return
             buf += data
             left = length - len(buf)
             if left > 0:
@@ -66,6 +73,8 @@ class DConnectHandler(BaseRequestHandler):
         app = self.server.app
         log = app.log
         try:
+            if app.workers is not None and app.workers.route(self.sock):
+                return
             header = self.recv(60)  # 60 - length of header
             if header is None:
                 log.warning('Header receive timeout')
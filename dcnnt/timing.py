@@ -0,0 +1,41 @@
+"""Measurement of startup stages: imports and initialization of components"""
+
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import List, Tuple, Optional
+
+
+class StartupProfile:
+    """Durations of startup stages and moments of readiness counted from start"""
+
+    def __init__(self, start: Optional[float] = None):
+        self.start = time.perf_counter() if start is None else start
+        self.lock = Lock()
+        self.stages: List[Tuple[str, float]] = list()
+        self.marks: List[Tuple[str, float]] = list()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Measure duration of code block"""
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - begin
+            with self.lock:
+                self.stages.append((name, duration))
+
+    def mark(self, name: str):
+        """Save time passed from start"""
+        elapsed = time.perf_counter() - self.start
+        with self.lock:
+            self.marks.append((name, elapsed))
+
+    def report(self) -> str:
+        """Get text table of measured stages and marks in milliseconds"""
+        with self.lock:
+            rows = [(f'  {name}', duration) for name, duration in self.stages]
+            rows += [(f'  ready: {name}', elapsed) for name, elapsed in self.marks]
+        width = max((len(i[0]) for i in rows), default=0)
+        return '\n'.join(['Startup profile, ms:'] + [f'{name.ljust(width)} {value * 1000:9.1f}' for name, value in rows])
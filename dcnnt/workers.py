@@ -0,0 +1,150 @@
+"""Worker processes accepting TCP connections on one port (SO_REUSEPORT) to use several CPU cores"""
+
+import os
+import time
+import signal
+import socket
+from array import array
+from contextlib import ExitStack
+from threading import Thread
+from typing import List, Optional, Tuple
+
+
+class WorkerPool:
+    """Forked worker processes, each one accepts connections on own socket bound to the same port.
+    Connections of one device are handled by one worker (UIN modulo count of workers), so per-device state
+    of plugins (jobs, snapshots, etc) stays in one process: connection accepted by other worker is passed
+    to home worker with file descriptor over UNIX socket. Master process owns UDP discovery and saving of devices"""
+    PASS_TIMEOUT = 5.0  # seconds to wait for passing of connection to other worker
+    STOP_TIMEOUT = 10.0  # seconds to wait for workers exit before kill
+    PARENT_CHECK_INTERVAL = 1.0
+
+    def __init__(self, app, count: int):
+        self.app, self.count = app, count
+        self.index: Optional[int] = None  # index of current worker, None in master process
+        self.master_pid = os.getpid()
+        self.pids: List[Optional[int]] = [None] * count
+        self.channels: List[Tuple[socket.socket, socket.socket]] = \
+            [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(count)]
+        for _, sender in self.channels:
+            sender.settimeout(self.PASS_TIMEOUT)
+        self.stopping = False
+
+    def start(self):
+        """Start all workers, must be called in main thread before start of any threads in master.
+        Exited workers are restarted by SIGCHLD handler, so they are forked by main thread too"""
+        signal.signal(signal.SIGCHLD, self.on_sigchld)
+        for index in range(self.count):
+            self.spawn(index)
+
+    def spawn(self, index: int):
+        """Fork worker process, it never returns in child. Locks of master which other threads may hold
+        are acquired for time of fork, so child gets them released"""
+        with ExitStack() as stack:
+            for lock in self.app.fork_locks():
+                stack.enter_context(lock)
+            pid = os.fork()
+        if pid:
+            self.pids[index] = pid
+            return
+        code = 1
+        try:
+            self.index = index
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, lambda *args: self.app.stop_worker())
+            Thread(target=self.watch_master, name='Thread-Worker-Master-Watch', daemon=True).start()
+            self.app.run_worker(index)
+            code = 0
+        except BaseException as e:
+            self.app.log.exception(e)
+        finally:
+            os._exit(code)
+
+    def watch_master(self):
+        """Exit worker if master process is dead"""
+        while os.getppid() == self.master_pid:
+            time.sleep(self.PARENT_CHECK_INTERVAL)
+        self.app.log.warning(f'Master process exited, stop worker {self.index}')
+        os._exit(1)
+
+    def on_sigchld(self, *args):
+        """SIGCHLD handler of master, reap exited workers and restart unexpectedly exited ones"""
+        for index, pid in enumerate(self.pids):
+            if pid is None:
+                continue
+            try:
+                pid, status = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                status = 0
+            if not pid:
+                continue
+            self.pids[index] = None
+            if not self.stopping:
+                self.app.log.error(f'Worker {index} (PID {pid}) exited unexpectedly with status {status}, restart')
+                self.spawn(index)
+
+    def send_signal(self, signum: int):
+        """Send signal to all workers"""
+        for pid in self.pids:
+            if pid is not None:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def stop(self):
+        """Stop all workers, kill ones not stopped in time"""
+        self.stopping = True
+        self.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + self.STOP_TIMEOUT
+        while any(i is not None for i in self.pids) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.send_signal(signal.SIGKILL)
+
+    def home(self, uin: int) -> int:
+        """Get index of worker handling connections of device"""
+        return uin % self.count
+
+    def route(self, sock: socket.socket) -> bool:
+        """Pass connection to home worker of device if it is not current one, return True if passed"""
+        try:
+            header = sock.recv(24, socket.MSG_PEEK | socket.MSG_WAITALL)  # UIN of source in bytes 20-24
+        except OSError:
+            return False
+        if len(header) < 24:
+            return False
+        index = self.home(int.from_bytes(header[20:24], 'big'))
+        if index == self.index:
+            return False
+        try:
+            self.channels[index][1].sendmsg([b'c'], [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                                                      array('i', (sock.fileno(), )))])
+        except OSError as e:
+            self.app.log.warning(f'Could not pass connection to worker {index}: {e}')
+            return False
+        self.app.log.debug(f'Connection passed from worker {self.index} to worker {index}')
+        return True
+
+    def receive_forever(self, server):
+        """Accept connections passed from other workers and process them by server, runs in worker"""
+        receiver = self.channels[self.index][0]
+        fds = array('i')
+        while True:
+            try:
+                _, ancdata, _, _ = receiver.recvmsg(1, socket.CMSG_SPACE(fds.itemsize))
+            except InterruptedError:
+                continue
+            except OSError as e:
+                self.app.log.error(f'Receive of passed connections stopped: {e}')
+                return
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    for fd in array('i', data[:len(data) - len(data) % fds.itemsize]):
+                        sock = socket.socket(fileno=fd)
+                        try:
+                            address = sock.getpeername()
+                        except OSError:
+                            sock.close()
+                            continue
+                        server.process_request(sock, address)
@@ -31,6 +31,11 @@ setuptools.setup(
     keywords=['phone', 'android', 'sync', 'device'],
     python_requires='>=3.7',
     install_requires=['pycryptodome>=3.9.3'],
+    extras_require={
+        'zstd': ['zstandard>=0.17'],
+        'thumbnails': ['Pillow>=8.0'],
+        'openssl': ['cryptography>=41.0'],
+    },
     entry_points={
         'console_scripts': [
             'dcnnt=dcnnt.dcnnt:main',